@@ -0,0 +1,49 @@
+import logging
+from typing import Any
+
+from pydantic import BaseModel
+
+from http_cache import CACHE_FOLDER, write_atomic
+
+STATE_PATH = f"{CACHE_FOLDER}/aggregate_state.json"
+
+# every merged token of the last run, whatever tiers are written out
+SNAPSHOT_PATH = f"{CACHE_FOLDER}/merged.msgpack"
+
+# bump whenever merging or the output format changes, so the next run rebuilds every chain
+STATE_VERSION = 1
+
+log = logging.getLogger(__name__)
+
+
+class AggregateState(BaseModel):
+    version: int = STATE_VERSION
+    settings: dict[str, Any] = {}
+    # chain id -> provider name -> fingerprints of the batches it got tokens from
+    inputs: dict[int, dict[str, list[str]]] = {}
+
+    @classmethod
+    def load(cls, settings: dict[str, Any]) -> "AggregateState":
+        try:
+            state = cls.parse_file(STATE_PATH)
+        except (OSError, ValueError):
+            return cls(settings=settings)
+        if state.version != STATE_VERSION or state.settings != settings:
+            log.info("aggregation settings changed, rebuilding every chain")
+            return cls(settings=settings)
+        return state
+
+    def save(self) -> None:
+        write_atomic(STATE_PATH, self.json().encode())
+
+    def add_input(self, chain_id: int, provider_name: str, fingerprint: str) -> None:
+        fingerprints = self.inputs.setdefault(chain_id, {}).setdefault(provider_name, [])
+        if fingerprint not in fingerprints:
+            fingerprints.append(fingerprint)
+            fingerprints.sort()
+
+    def has_input(self, chain_id: int, provider_name: str, fingerprint: str) -> bool:
+        return fingerprint in self.inputs.get(chain_id, {}).get(provider_name, [])
+
+    def changed_chains(self, previous: "AggregateState") -> set[int]:
+        return {chain_id for chain_id, inputs in self.inputs.items() if previous.inputs.get(chain_id) != inputs}
@@ -1,84 +1,340 @@
 import asyncio
 import json
 import logging
+import os
+import sys
+import time
 from collections import defaultdict
+from itertools import compress
+from operator import attrgetter
+from typing import Optional
 
-from coingecko_ids import CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID
-from common import Address, ChainId, NATIVE_ADDR_0x0, NATIVE_ADDR_0xe, NATIVE_MATIC_ADDR, Token, CHAIN_NAMES_BY_ID
-from token_list_providers import CoinGeckoTokenLists, Lifinance, OneInchTokenLists, RubicLists, tokenlists_providers
+import http_client
+import parse_executor
+from aggregate_state import SNAPSHOT_PATH, AggregateState
+from change_feed import feed_files
+from coingecko_ids import CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID, cached_coingecko_ids, get_coingecko_ids
+from common import (
+    Address, ChainId, NATIVE_ADDR_0x0, NATIVE_ADDR_0xe, NATIVE_MATIC_ADDR, Token, TokenRecord, CHAIN_NAMES_BY_ID, _intern
+)
+from metrics import RunReport, start_run
+from output_writer import (
+    DELTAS_FOLDER, MINIFY_OUTPUT, TIER_DELTAS, all_file, chain_file, compressed, encode_tokens, write_files
+)
+from token_list_providers import TokenBatch, TokenListProvider, tokenlists_providers
+from token_index import build_index
+from token_search import SearchIndex
+from tokenlist_loader import load_all, pack_tokens
+from trust_policy import POLICY_FIELDS, CompiledRules, TrustPolicy
 
-TOKENLISTS_FOLDER = "tokenlists"
-
-ALL_TOKENS_FOLDER = "all_tokens"
+# seconds after which unfinished fetches are abandoned and their cached inputs used instead, 0 to wait for all
+RUN_DEADLINE = float(os.environ.get("TOKENLISTS_RUN_DEADLINE", 600))
 
 log = logging.getLogger(__name__)
 
 
-async def collect_trusted_tokens() -> dict[int, list[Token]]:
-    data = await asyncio.gather(
-        *[provider.get_tokenlists() for provider in
-            tokenlists_providers]
-        )
-    provider_data: dict[str, dict[str, list[Token]]] = {}
-    for prov in data:
-        provider_data |= prov
-
-    res: dict[int, dict[Address, Token]] = defaultdict(dict)
-    for provider_name, tokens_by_chains in provider_data.items():
-        for _chain_id, tokens in tokens_by_chains.items():
-            chain_id = int(_chain_id)
-            if chain_id == 101:  # solana
-                chain_id = -1
-            for token in tokens:
-                addr = Address(token.address.lower())
-                if token.chainId == 101:
-                    token.chainId = ChainId(-1)
-                if addr == NATIVE_ADDR_0xe or addr == NATIVE_MATIC_ADDR:
-                    addr = NATIVE_ADDR_0x0
-                    token.address = NATIVE_ADDR_0x0
+def _merged_chain_id(token: Token) -> int:
+    chain_id = int(token.chainId)
+    if chain_id == 101:  # solana
+        return -1
+    return chain_id
+
+
+def _split_by_chain(tokens: list[Token]) -> dict[int, list[Token]]:
+    res: dict[int, list[Token]] = defaultdict(list)
+    for token in tokens:
+        res[_merged_chain_id(token)].append(token)
+    return res
+
+
+class MergedToken(TokenRecord):
+    # rank of the provider the base fields come from, a bitmask of the providers listing the token
+    # (bit i is the provider ranked i), and the priority of every field the trust policy picks a source for
+    __slots__ = ("rank", "providers", "symbolPriority", "namePriority", "logoURIPriority")
+
+    rank: int
+    providers: int
+    symbolPriority: tuple[int, int]
+    namePriority: tuple[int, int]
+    logoURIPriority: tuple[int, int]
+
+
+def _rule_priority(rules: CompiledRules, value: Optional[str]) -> tuple[int, int]:
+    for contains, priority in rules:
+        if contains is None or (value and contains in value):
+            return priority
+    raise AssertionError("compiled rules end with a fallback")
+
+
+# batches are merged in arrival order, but the result doesn't depend on it: base fields come from the provider
+# listed first in tokenlists_providers, policy fields are picked by priority and listedIn is kept in provider order
+class TokenMerger:
+    def __init__(self, providers: list[type[TokenListProvider]], policy: TrustPolicy):
+        self.ranks = {sys.intern(provider.name): i for i, provider in enumerate(providers)}
+        self.names = list(self.ranks)
+        # provider -> (field, its priority slot, the rules for the provider's values) of every field with rules
+        self.field_rules: dict[str, list[tuple[str, str, CompiledRules]]] = {name: [] for name in self.names}
+        for field in POLICY_FIELDS:
+            if policy.fields.get(field):
+                for name, rules in policy.compile_field_rules(field, self.names).items():
+                    self.field_rules[name].append((field, f"{field}Priority", rules))
+        self.tokens: dict[int, dict[Address, MergedToken]] = defaultdict(dict)
+        self._listed_in: dict[int, list[str]] = {}
+
+    def add(self, provider_name: str, tokens: list[Token]) -> None:
+        # every token costs one dict lookup and a few comparisons, however many providers list it
+        provider_name = sys.intern(provider_name)
+        rank = self.ranks[provider_name]
+        bit = 1 << rank
+        field_rules = self.field_rules[provider_name]
+        chain_id = None
+        records: dict[Address, MergedToken] = {}
+        for token in tokens:
+            if token.chainId != chain_id:
+                chain_id = token.chainId
+                records = self.tokens[_merged_chain_id(token)]
+            addr = Address(token.address.lower())
+            if addr == NATIVE_ADDR_0xe or addr == NATIVE_MATIC_ADDR:
+                addr = NATIVE_ADDR_0x0
+
+            record = records.get(addr)
+            if record is None or rank < record.rank:
+                new_record = MergedToken.from_token(token)
+                new_record.chainId = ChainId(_merged_chain_id(token))
                 if addr == NATIVE_ADDR_0x0:
-                    token.coingeckoId = CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID.get(token.chainId)
-                if addr in res[chain_id]:
-                    # 1inch has best token logos
-                    if provider_name == OneInchTokenLists.name:
-                        res[chain_id][addr].logoURI = token.logoURI
-                    # coingecko and lifinance have worst token logos
-                    elif (
-                        provider_name not in (Lifinance.name, CoinGeckoTokenLists.name, RubicLists.name) and
-                        ("tokens.1inch.io" not in (res[chain_id][addr].logoURI or []))
-                    ):
-                        res[chain_id][addr].logoURI = token.logoURI
-                    if provider_name not in res[chain_id][addr].listedIn:
-                        res[chain_id][addr].listedIn.append(provider_name)
-
-                else:
-                    res[chain_id][addr] = token
-                    res[chain_id][addr].listedIn.append(provider_name)
-
-    all_tokens = {
-        k: list(sorted(v.values(), key=lambda x: x.address, reverse=True)) for k, v in res.items() if len(v) > 0
-    }
+                    new_record.address = NATIVE_ADDR_0x0
+                    new_record.coingeckoId = CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID.get(new_record.chainId)
+                new_record.rank = rank
+                new_record.providers = bit
+                for field, priority_slot, rules in field_rules:
+                    priority = _rule_priority(rules, getattr(token, field))
+                    if record is not None and getattr(record, priority_slot) > priority:
+                        setattr(new_record, field, getattr(record, field))
+                        priority = getattr(record, priority_slot)
+                    setattr(new_record, priority_slot, priority)
+                if record is not None:
+                    new_record.providers |= record.providers
+                records[addr] = new_record
+            else:
+                record.providers |= bit
+                for field, priority_slot, rules in field_rules:
+                    value = getattr(token, field)
+                    priority = _rule_priority(rules, value)
+                    if priority > getattr(record, priority_slot):
+                        setattr(record, field, _intern(value))
+                        setattr(record, priority_slot, priority)
+
+    def _provider_names(self, providers: int) -> list[str]:
+        # only a few hundred distinct provider combinations exist, each is expanded once
+        names = self._listed_in.get(providers)
+        if names is None:
+            names = self._listed_in[providers] = [name for i, name in enumerate(self.names) if providers >> i & 1]
+        return names
+
+    def merged(self) -> dict[int, list[TokenRecord]]:
+        res: dict[int, list[TokenRecord]] = {}
+        for chain_id in sorted(self.tokens):
+            records = self.tokens[chain_id]
+            if not records:
+                continue
+            for record in records.values():
+                # tokens listed by the same providers share one list, nothing mutates listedIn after the merge
+                record.listedIn = self._provider_names(record.providers)
+            res[chain_id] = sorted(records.values(), key=attrgetter("address"), reverse=True)
+        return res
+
 
-    trusted = {k: [t for t in v if len(t.listedIn) > 1] for k, v in all_tokens.items()}
+def _read(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
 
-    # trusted tokens
-    for chain_id, tokens in trusted.items():
-        filename = f"{TOKENLISTS_FOLDER}/{CHAIN_NAMES_BY_ID.get(str(chain_id), chain_id)}.json"
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump([t.dict() for t in tokens], f, ensure_ascii=False, indent=4)
-    with open(f"{TOKENLISTS_FOLDER}/all.json", "w", encoding="utf-8") as f:
-        json.dump({k: [t.dict() for t in v] for k, v in trusted.items()}, f, ensure_ascii=False, indent=4)
 
-    # all tokens found
+def _tier_delta(previous: dict[int, list[TokenRecord]], current: dict[int, list[TokenRecord]]) -> bytes:
+    delta = {}
+    for chain_id in sorted(previous.keys() | current.keys()):
+        before = {t.address for t in previous.get(chain_id, [])}
+        after = {t.address for t in current.get(chain_id, [])}
+        if before != after:
+            delta[str(chain_id)] = {"entered": sorted(after - before), "left": sorted(before - after)}
+    return json.dumps(delta, indent=None if MINIFY_OUTPUT else 4).encode()
+
+
+async def write_outputs(
+    all_tokens: dict[int, list[TokenRecord]],
+    previous_tokens: dict[int, list[TokenRecord]],
+    changed: set[int],
+    policy: TrustPolicy,
+) -> list[str]:
+    folders = {name: tier.folder for name, tier in policy.tiers.items() if tier.folder is not None}
+    # what every tier held before this run, read before anything is overwritten
+    previous_tiers = {
+        name: load_all(f"{folder}/all.msgpack") if os.path.exists(f"{folder}/all.msgpack") else {}
+        for name, folder in folders.items()
+    } if TIER_DELTAS else {}
+    snapshot = pack_tokens(all_tokens)
+    files: dict[str, bytes] = {SNAPSHOT_PATH: snapshot}
+    tier_tokens: dict[str, dict[int, list[TokenRecord]]] = {name: {} for name in folders}
+    tier_chain_files: dict[str, dict[int, bytes]] = {name: {} for name in folders}
+    # one pass over the merged chains: every changed token is encoded once and its bytes are shared by all tiers
     for chain_id, tokens in all_tokens.items():
-        filename = f"{ALL_TOKENS_FOLDER}/{CHAIN_NAMES_BY_ID.get(str(chain_id), chain_id)}.json"
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump([t.dict() for t in tokens], f, ensure_ascii=False, indent=4)
-    with open(f"{ALL_TOKENS_FOLDER}/all.json", "w", encoding="utf-8") as f:
-        json.dump({k: [t.dict() for t in v] for k, v in all_tokens.items()}, f, ensure_ascii=False, indent=4)
+        chain_name = CHAIN_NAMES_BY_ID.get(str(chain_id), chain_id)
+        in_tiers = policy.tiers_of(chain_id, tokens)
+        encoded = encode_tokens(tokens) if chain_id in changed else None
+        # chain file and index of tiers holding every token of the chain
+        complete: Optional[tuple[bytes, Optional[bytes]]] = None
+        for name, folder in folders.items():
+            members = tier_tokens[name][chain_id] = list(compress(tokens, in_tiers[name]))
+            path = f"{folder}/{chain_name}.json"
+            if encoded is None:
+                # the chain's inputs are the same as on the previous run, so is its file
+                data = _read(path)
+                if data is None:
+                    data = files[path] = chain_file(encode_tokens(members))
+                tier_chain_files[name][chain_id] = data
+                continue
+            if len(members) == len(tokens):
+                if complete is None:
+                    complete = chain_file(encoded), build_index(tokens)
+                data, index = complete
+            else:
+                data, index = chain_file(list(compress(encoded, in_tiers[name]))), build_index(members)
+            tier_chain_files[name][chain_id] = files[path] = data
+            if index is not None:
+                files[f"{folder}/index/{chain_name}.idx"] = index
+
+    for name, folder in folders.items():
+        files[f"{folder}/all.json"] = all_file(tier_chain_files[name])
+        files |= compressed(f"{folder}/all.json", files[f"{folder}/all.json"])
+        tokens_by_chain = tier_tokens[name]
+        if all(len(tokens_by_chain[k]) == len(v) for k, v in all_tokens.items()):
+            files[f"{folder}/all.msgpack"] = snapshot
+        else:
+            files[f"{folder}/all.msgpack"] = pack_tokens(tokens_by_chain)
+        files[f"{folder}/search.msgpack"] = SearchIndex.build(tokens_by_chain).to_bytes()
+        if TIER_DELTAS:
+            files[f"{DELTAS_FOLDER}/{name}.json"] = _tier_delta(previous_tiers[name], tokens_by_chain)
+    files |= feed_files(previous_tokens, all_tokens, changed, policy)
+    return await write_files(files)
+
+
+def _merge(merger: TokenMerger, report: RunReport, provider_name: str, chain_id: int, tokens: list[Token]) -> None:
+    started = time.perf_counter()
+    merger.add(provider_name, tokens)
+    report.add_merge(provider_name, chain_id, len(tokens), time.perf_counter() - started)
+
+
+def _fill_from_cache(
+    report: RunReport,
+    received: set[tuple[str, str]],
+    coingecko_ids: "asyncio.Future[dict[str, dict[Address, str]]]",
+) -> list[TokenBatch]:
+    # urls that weren't fetched in time get the tokens of their last successful fetch
+    if coingecko_ids.done() and not coingecko_ids.cancelled() and coingecko_ids.exception() is None:
+        ids = coingecko_ids.result()
+    else:
+        coingecko_ids.cancel()
+        ids = cached_coingecko_ids()
+    batches = []
+    for provider in tokenlists_providers:
+        for url, chains in provider.urls().items():
+            if (provider.name, url) in received:
+                continue
+            report.mark_stale(provider.name, url, [chain_id for chain_id, _ in chains], "run deadline exceeded")
+            batch = provider.cached_batch(url, chains, ids)
+            if batch is not None:
+                batches.append(batch)
+    return batches
+
+
+async def collect_trusted_tokens() -> dict[int, list[Token]]:
+    report = start_run()
+    started = time.perf_counter()
+    policy = TrustPolicy.load()
+    previous = AggregateState.load({
+        "minified": MINIFY_OUTPUT,
+        "providers": {p.name: p.spec.fingerprint() for p in tokenlists_providers},
+        "trust_policy": policy.fingerprint(),
+    })
+    state = AggregateState(settings=previous.settings)
+    merger = TokenMerger(tokenlists_providers, policy)
+    # batches identical to the previous run's are only merged if something else changed on their chain
+    unchanged_batches: dict[int, list[tuple[str, list[Token]]]] = defaultdict(list)
+    received: set[tuple[str, str]] = set()
+
+    def add_batch(batch: TokenBatch) -> None:
+        provider_name, url, tokens, fingerprint = batch
+        received.add((provider_name, url))
+        for chain_id, chain_tokens in _split_by_chain(tokens).items():
+            state.add_input(chain_id, provider_name, fingerprint)
+            if previous.has_input(chain_id, provider_name, fingerprint):
+                unchanged_batches[chain_id].append((provider_name, chain_tokens))
+            else:
+                _merge(merger, report, provider_name, chain_id, chain_tokens)
+
+    queue: asyncio.Queue[Optional[TokenBatch]] = asyncio.Queue()
+    # the coingecko index is built while providers are downloading
+    coingecko_ids = get_coingecko_ids()
+    producers = asyncio.gather(*[provider.stream_tokenlists(queue) for provider in tokenlists_providers])
+    producers.add_done_callback(lambda _: queue.put_nowait(None))
+    deadline = started + RUN_DEADLINE if RUN_DEADLINE else None
+    try:
+        # each batch is merged as soon as it is parsed, while other providers are still downloading
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            try:
+                batch = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                log.warning(f"run deadline of {RUN_DEADLINE:.0f}s exceeded, using cached inputs for unfinished fetches")
+                report.deadline_exceeded = True
+                producers.cancel()
+                await asyncio.gather(producers, return_exceptions=True)
+                while not queue.empty():
+                    if (batch := queue.get_nowait()) is not None:
+                        add_batch(batch)
+                for batch in _fill_from_cache(report, received, coingecko_ids):
+                    add_batch(batch)
+                break
+            if batch is None:
+                await producers
+                await coingecko_ids
+                break
+            add_batch(batch)
+    finally:
+        producers.cancel()
+        await http_client.close_client()
+        parse_executor.shutdown_executor()
+
+    # also what the change feed compares against, so it's loaded even when every chain is rebuilt
+    previous_tokens = load_all(SNAPSHOT_PATH) if os.path.exists(SNAPSHOT_PATH) else {}
+    changed = state.changed_chains(previous) | {k for k in state.inputs if k not in previous_tokens}
+    for chain_id in changed:
+        for provider_name, tokens in unchanged_batches.pop(chain_id, []):
+            _merge(merger, report, provider_name, chain_id, tokens)
+    unchanged_batches.clear()
+
+    all_tokens = merger.merged()
+    for chain_id in state.inputs.keys() - changed:
+        all_tokens[chain_id] = previous_tokens[chain_id]
+    all_tokens = dict(sorted(all_tokens.items()))
+
+    if changed or previous.inputs.keys() - state.inputs.keys():
+        log.info(f"{len(changed)} of {len(state.inputs)} chains changed")
+        report.files_written = len(await write_outputs(all_tokens, previous_tokens, changed, policy))
+    else:
+        log.info("no provider inputs changed, outputs are up to date")
+    state.save()
+    report.chains_changed = len(changed)
+    report.duration_seconds = time.perf_counter() - started
+    report.save()
 
     log.info("Succesfully collected trusted tokens")
-    return trusted
+    return {
+        k: [t.to_token() for t in compress(v, policy.tiers_of(k, v)[policy.default_tier])]
+        for k, v in all_tokens.items()
+    }
 
 
 if __name__ == "__main__":
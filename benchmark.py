@@ -0,0 +1,391 @@
+import argparse
+import asyncio
+import gc
+import gzip
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Callable, Optional
+
+import httpx
+
+import http_client
+import parse_executor
+from aggregate_tokens import TokenMerger, _split_by_chain, collect_trusted_tokens, write_outputs
+from coingecko_ids import COINGECKO_COINS_LIST_URL
+from common import ALL_TOKENS_FOLDER, TOKENLISTS_FOLDER
+from generate_readme import generate_readme
+from token_list_providers import TokenListProvider, tokenlists_providers
+from trust_policy import TrustPolicy
+
+REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS_FOLDER = os.path.join(REPO_FOLDER, "benchmarks")
+
+FIXTURES_FOLDER = os.path.join(BENCHMARKS_FOLDER, "fixtures")
+
+BASELINE_PATH = os.path.join(BENCHMARKS_FOLDER, "baseline.json")
+
+# urls without a recorded fixture get this many synthetic tokens per chain before scaling
+SYNTHETIC_TOKENS_PER_CHAIN = 300
+
+# a stage regresses when it is this much slower, or needs this much more memory, than the baseline
+REGRESSION_TOLERANCE = 0.3
+
+log = logging.getLogger(__name__)
+
+
+def _provider_urls() -> list[tuple[type[TokenListProvider], str, list[str]]]:
+    chains_by_url: dict[tuple[type[TokenListProvider], str], list[str]] = defaultdict(list)
+    for provider in tokenlists_providers:
+        for chain_id, chain_name in provider.chains.items():
+            chains_by_url[(provider, provider._url(chain_id, chain_name))].append(chain_id)
+    return [(provider, url, chains) for (provider, url), chains in chains_by_url.items()]
+
+
+def _fixture_path(url: str) -> str:
+    return os.path.join(FIXTURES_FOLDER, f"{hashlib.sha256(url.encode()).hexdigest()[:16]}.json.gz")
+
+
+async def record_fixtures() -> None:
+    os.makedirs(FIXTURES_FOLDER, exist_ok=True)
+    manifest = {}
+    urls = [url for _, url, _ in _provider_urls()] + [COINGECKO_COINS_LIST_URL]
+    try:
+        for url in urls:
+            resp = await http_client.get(url)
+            if resp.status_code != 200:
+                log.warning(f"not recording {url}, got {resp.status_code}")
+                continue
+            with open(_fixture_path(url), "wb") as f:
+                f.write(gzip.compress(resp.content, mtime=0))
+            manifest[url] = os.path.basename(_fixture_path(url))
+            log.info(f"recorded {url}")
+    finally:
+        await http_client.close_client()
+    with open(os.path.join(FIXTURES_FOLDER, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+
+def _load_fixtures() -> dict[str, Any]:
+    try:
+        with open(os.path.join(FIXTURES_FOLDER, "manifest.json")) as f:
+            manifest = json.load(f)
+    except OSError:
+        return {}
+    res = {}
+    for url, filename in manifest.items():
+        with open(os.path.join(FIXTURES_FOLDER, filename), "rb") as f:
+            res[url] = json.loads(gzip.decompress(f.read()))
+    return res
+
+
+def _copy_address(address: str, i: int) -> str:
+    if address.startswith("0x") and len(address) == 42:
+        return f"{address[:-8]}{i:08x}"
+    return f"{address}{i}"
+
+
+def _copy_token(token: dict[str, Any], i: int) -> dict[str, Any]:
+    token = dict(token)
+    token["address"] = _copy_address(token["address"], i)
+    return token
+
+
+def _is_token(value: Any) -> bool:
+    return isinstance(value, dict) and isinstance(value.get("address"), str)
+
+
+def _scale(body: Any, factor: int) -> Any:
+    # copies of every token differ only in the address, so providers keep overlapping the same way at any scale
+    if factor == 1:
+        return body
+    if isinstance(body, list) and body and all(_is_token(t) for t in body):
+        return body + [_copy_token(t, i) for i in range(1, factor) for t in body]
+    if isinstance(body, dict) and body and all(_is_token(t) for t in body.values()):
+        res = dict(body)
+        for i in range(1, factor):
+            for t in body.values():
+                copy = _copy_token(t, i)
+                res[copy["address"]] = copy
+        return res
+    if isinstance(body, dict):
+        return {k: _scale(v, factor) for k, v in body.items()}
+    return body
+
+
+def _synthetic_address(chain_id: str, i: int) -> str:
+    return f"0x{hashlib.sha256(f'{chain_id}:{i}'.encode()).hexdigest()[:40]}"
+
+
+def _synthetic_body(provider: type[TokenListProvider], url: str, chains: list[str], n: int) -> Any:
+    # every url lists a random half of a per-chain pool, so most tokens end up listed by several providers;
+    # the body has the shape the provider's extractor reads
+    rnd = random.Random(url)
+    host = httpx.URL(url).host
+    extract = provider.spec.extract
+    tokens_by_chain = {}
+    for chain_id in chains:
+        tokens_by_chain[chain_id] = [
+            {
+                "symbol": f"T{i}",
+                "name": f"Token {i}",
+                "address": _synthetic_address(chain_id, i),
+                "decimals": 18,
+                "chainId": int(chain_id),
+                "logoURI": f"https://{host}/logos/{_synthetic_address(chain_id, i)}.png",
+            }
+            for i in sorted(rnd.sample(range(n * 2), n))
+        ]
+    for tokens in tokens_by_chain.values():
+        for i, t in enumerate(tokens):
+            if extract.chain_id == "absent":
+                del t["chainId"]
+            tokens[i] = {
+                field if field in keys else keys[0]: value
+                for field, value in t.items()
+                if (keys := extract.source_keys(field))
+            }
+
+    def listing(tokens: list[dict[str, Any]]) -> Any:
+        if not extract.values:
+            return tokens
+        key = extract.key_field or "address"
+        return {t[key]: {k: v for k, v in t.items() if k != extract.key_field} for t in tokens}
+
+    def nest(path: list[str], tokens_by_chain: dict[str, list[dict[str, Any]]]) -> Any:
+        if not path:
+            return listing([t for chain_tokens in tokens_by_chain.values() for t in chain_tokens])
+        if "{chain_id}" in path[0]:
+            return {
+                path[0].format(chain_id=chain_id): nest(path[1:], {chain_id: tokens})
+                for chain_id, tokens in tokens_by_chain.items()
+            }
+        return {path[0]: nest(path[1:], tokens_by_chain)}
+
+    return nest(extract.path, tokens_by_chain)
+
+
+def _synthetic_coins() -> list[dict[str, Any]]:
+    # coingecko ids for ethereum tokens, the other chains go through the same code path
+    return [
+        {"id": f"coin-{i}", "symbol": f"t{i}", "name": f"Token {i}", "platforms": {"ethereum": _synthetic_address("1", i)}}
+        for i in range(SYNTHETIC_TOKENS_PER_CHAIN)
+    ]
+
+
+def build_responses(scale: int) -> dict[str, bytes]:
+    fixtures = _load_fixtures()
+    bodies: dict[str, bytes] = {}
+    for provider, url, chains in _provider_urls():
+        if url in fixtures:
+            body = _scale(fixtures[url], scale)
+        else:
+            body = _synthetic_body(provider, url, chains, SYNTHETIC_TOKENS_PER_CHAIN * scale)
+        bodies[url] = json.dumps(body).encode()
+    coins = fixtures.get(COINGECKO_COINS_LIST_URL) or _synthetic_coins()
+    bodies[COINGECKO_COINS_LIST_URL] = json.dumps(coins).encode()
+    return bodies
+
+
+def mock_transport(bodies: dict[str, bytes]) -> httpx.MockTransport:
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = bodies.get(str(request.url))
+        if body is None:
+            return httpx.Response(404)
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(200, content=body, headers={"ETag": etag, "Content-Type": "application/json"})
+
+    return httpx.MockTransport(handler)
+
+
+def _reset_workdir() -> None:
+    for folder in (".cache", TOKENLISTS_FOLDER, ALL_TOKENS_FOLDER):
+        shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(TOKENLISTS_FOLDER)
+    os.makedirs(ALL_TOKENS_FOLDER)
+
+
+async def _get_tokenlists() -> list[tuple[str, list]]:
+    try:
+        results = await asyncio.gather(*[provider.get_tokenlists() for provider in tokenlists_providers])
+    finally:
+        await http_client.close_client()
+        parse_executor.shutdown_executor()
+    return [
+        (provider_name, tokens)
+        for result in results
+        for provider_name, tokens_by_chain in result.items()
+        for tokens in tokens_by_chain.values()
+    ]
+
+
+class Bench:
+    def __init__(self, scale: int, repeat: int, bodies: dict[str, bytes]):
+        self.scale = scale
+        self.repeat = repeat
+        self.bodies = bodies
+        self.results: dict[str, dict[str, float]] = {}
+
+    def measure(
+        self,
+        stage: str,
+        fn: Callable[[], Any],
+        count: Callable[[Any], int],
+        setup: Optional[Callable[[], None]] = None,
+    ) -> Any:
+        # best of n runs for time, one more run under tracemalloc for peak python memory
+        seconds = float("inf")
+        res = None
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            gc.collect()
+            started = time.perf_counter()
+            res = fn()
+            seconds = min(seconds, time.perf_counter() - started)
+        if setup is not None:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        tokens = count(res)
+        self.results[stage] = {
+            "seconds": seconds,
+            "tokens": tokens,
+            "tokens_per_second": tokens / seconds if seconds else 0,
+            "peak_bytes": peak,
+        }
+        log.info(
+            f"[x{self.scale}] {stage}: {seconds:.3f}s, {tokens} tokens, "
+            f"{tokens / seconds if seconds else 0:,.0f} tokens/s, peak {peak / 2 ** 20:.1f} MiB"
+        )
+        return res
+
+    def run(self) -> dict[str, dict[str, float]]:
+        _reset_workdir()
+        batches = self.measure(
+            "get_tokenlists", lambda: asyncio.run(_get_tokenlists()), lambda res: sum(len(t) for _, t in res), _reset_workdir
+        )
+        fetched = sum(len(tokens) for _, tokens in batches)
+
+        decoded = [(provider, json.loads(self.bodies[url]), chains) for provider, url, chains in _provider_urls()]
+
+        def parse() -> int:
+            parsed = 0
+            for provider, tokenlist, chains in decoded:
+                for chain_id in chains:
+                    raw_tokens = provider.spec.extract.tokens_at(tokenlist, chain_id)
+                    parsed += len(provider._normalize_tokens(raw_tokens, chain_id, False)[0])
+            return parsed
+
+        self.measure("parse", parse, lambda parsed: parsed)
+
+        policy = TrustPolicy.load()
+
+        def merge() -> dict:
+            merger = TokenMerger(tokenlists_providers, policy)
+            for provider_name, tokens in batches:
+                for chain_tokens in _split_by_chain(tokens).values():
+                    merger.add(provider_name, chain_tokens)
+            return merger.merged()
+
+        all_tokens = self.measure("merge", merge, lambda _: fetched)
+        merged = sum(len(tokens) for tokens in all_tokens.values())
+        self.measure(
+            "write_outputs",
+            lambda: asyncio.run(write_outputs(all_tokens, all_tokens, set(all_tokens), policy)),
+            lambda _: merged,
+            _reset_workdir,
+        )
+        self.measure(
+            "collect_trusted_tokens", lambda: asyncio.run(collect_trusted_tokens()), lambda _: fetched, _reset_workdir
+        )
+        self.measure("generate_readme", generate_readme, lambda _: merged)
+        return self.results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    regressions = []
+    for scale, stages in results.items():
+        for stage, res in stages.items():
+            base = baseline.get(scale, {}).get(stage)
+            if base is None:
+                continue
+            for key in ("seconds", "peak_bytes"):
+                if base[key] and res[key] > base[key] * (1 + tolerance):
+                    regressions.append(f"x{scale} {stage} {key}: {res[key]:.3f} vs baseline {base[key]:.3f}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay recorded or synthetic provider responses offline")
+    parser.add_argument("--record", action="store_true", help="record live provider responses as fixtures and exit")
+    parser.add_argument("--scales", default="1,10", help="comma separated token count multipliers")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--output", help="also write the results as json to this path")
+    args = parser.parse_args()
+
+    if args.record:
+        asyncio.run(record_fixtures())
+        return 0
+
+    # per chain "OK" lines would drown the results
+    logging.getLogger("token_list_providers").setLevel(logging.WARNING)
+    logging.getLogger("output_writer").setLevel(logging.WARNING)
+    logging.getLogger("aggregate_tokens").setLevel(logging.WARNING)
+    logging.getLogger("metrics").setLevel(logging.WARNING)
+
+    results: dict[str, dict] = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="tokenlists-bench-") as workdir:
+        # outputs, the http cache, the run report and the configs all live relative to the working directory
+        for config in ("logger.yml", "trust_policy.yml", "providers.yml"):
+            shutil.copy(os.path.join(REPO_FOLDER, config), workdir)
+        os.chdir(workdir)
+        try:
+            for scale in (int(s) for s in args.scales.split(",")):
+                bodies = build_responses(scale)
+                http_client.set_transport(mock_transport(bodies))
+                results[str(scale)] = Bench(scale, args.repeat, bodies).run()
+        finally:
+            http_client.set_transport(None)
+            os.chdir(cwd)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        log.info(f"saved baseline to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        # timings only mean something against a baseline from the same machine, so none is committed
+        log.error(f"no baseline at {args.baseline} to compare with, run with --save-baseline to create one")
+        return 2
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        log.error(f"regression: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
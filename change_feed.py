@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import time
+from operator import attrgetter
+from typing import Any
+
+from pydantic import BaseModel
+
+from common import CHAIN_NAMES_BY_ID, TokenRecord
+from output_writer import MINIFY_OUTPUT
+from trust_policy import TrustPolicy
+
+CHANGES_FOLDER = os.environ.get("TOKENLISTS_CHANGES_FOLDER", "changes")
+
+# entries kept per chain, a consumer further behind reloads the chain's list instead
+CHANGE_FEED_LENGTH = int(os.environ.get("TOKENLISTS_CHANGE_FEED_LENGTH", 100))
+
+# bump whenever the feed format changes
+CHANGE_FEED_VERSION = 1
+
+# fields reported as changed, listedIn is reported as a trust change together with the tiers
+FEED_FIELDS = ("symbol", "name", "decimals", "logoURI", "coingeckoId")
+
+_feed_fields = attrgetter(*FEED_FIELDS)
+
+log = logging.getLogger(__name__)
+
+
+class FieldChange(BaseModel):
+    address: str
+    # new values of the fields that changed
+    fields: dict[str, Any]
+
+
+class TrustChange(BaseModel):
+    address: str
+    listedIn: list[str]
+    tiers: list[str]
+
+
+class FeedEntry(BaseModel):
+    sequence: int
+    timestamp: int
+    # the changes can't be described, e.g. the trust policy changed: consumers reload the chain's list
+    reset: bool = False
+    # full tokens, with the tiers they are in
+    added: list[dict[str, Any]] = []
+    removed: list[str] = []
+    trust: list[TrustChange] = []
+    changed: list[FieldChange] = []
+
+
+class ChainFeed(BaseModel):
+    version: int = CHANGE_FEED_VERSION
+    chainId: int
+    # sequence of the last entry, consumers apply every entry after the one they have
+    sequence: int = 0
+    entries: list[FeedEntry] = []
+
+    @classmethod
+    def load(cls, chain_id: int) -> "ChainFeed":
+        try:
+            feed = cls.parse_file(feed_path(chain_id))
+        except (OSError, ValueError):
+            return cls(chainId=chain_id)
+        if feed.version != CHANGE_FEED_VERSION:
+            # sequences keep increasing, the old entries are just dropped
+            return cls(chainId=chain_id, sequence=feed.sequence)
+        return feed
+
+    def append(self, entry: FeedEntry) -> None:
+        self.sequence = entry.sequence
+        self.entries = (self.entries + [entry])[-CHANGE_FEED_LENGTH:]
+
+    def to_bytes(self) -> bytes:
+        # entries leave out their empty lists
+        return json.dumps({
+            "version": self.version,
+            "chainId": self.chainId,
+            "sequence": self.sequence,
+            "entries": [entry.dict(exclude_defaults=True) for entry in self.entries],
+        }, ensure_ascii=False, indent=None if MINIFY_OUTPUT else 4).encode()
+
+
+def feed_path(chain_id: int) -> str:
+    return f"{CHANGES_FOLDER}/{CHAIN_NAMES_BY_ID.get(str(chain_id), chain_id)}.json"
+
+
+def _tier_names(chain_id: int, tokens: list[TokenRecord], policy: TrustPolicy) -> list[list[str]]:
+    in_tiers = policy.tiers_of(chain_id, tokens)
+    return [[name for name, members in in_tiers.items() if members[i]] for i in range(len(tokens))]
+
+
+def diff_chain(
+    chain_id: int, previous: list[TokenRecord], current: list[TokenRecord], policy: TrustPolicy, entry: FeedEntry
+) -> None:
+    # previous tiers are computed with the current policy, a policy change resets the feed instead
+    before = {t.address: (t, tiers) for t, tiers in zip(previous, _tier_names(chain_id, previous, policy))}
+    for token, tiers in zip(current, _tier_names(chain_id, current, policy)):
+        old = before.pop(token.address, None)
+        if old is None:
+            entry.added.append(token.dict() | {"tiers": tiers})
+            continue
+        old_token, old_tiers = old
+        if token is old_token:
+            continue
+        if token.listedIn != old_token.listedIn or tiers != old_tiers:
+            entry.trust.append(TrustChange(address=token.address, listedIn=token.listedIn, tiers=tiers))
+        values, old_values = _feed_fields(token), _feed_fields(old_token)
+        if values != old_values:
+            entry.changed.append(FieldChange(
+                address=token.address,
+                fields={k: v for k, v, old_v in zip(FEED_FIELDS, values, old_values) if v != old_v},
+            ))
+    entry.removed = sorted(before)
+
+
+def feed_files(
+    previous: dict[int, list[TokenRecord]],
+    current: dict[int, list[TokenRecord]],
+    changed: set[int],
+    policy: TrustPolicy,
+) -> dict[str, bytes]:
+    index_path = f"{CHANGES_FOLDER}/index.json"
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    fingerprint = policy.fingerprint()
+    # without the previous tokens or with other tiers there is nothing to compare against
+    reset = not previous or index.get("version") != CHANGE_FEED_VERSION or index.get("trustPolicy") != fingerprint
+    sequences: dict[str, int] = index.get("chains", {}) if not reset else {}
+    chains = changed | (previous.keys() - current.keys())
+    if reset:
+        # consumers following the old tiers have to reload unchanged chains as well
+        chains |= current.keys()
+        log.info("change feed reset, consumers reload every chain")
+    files = {}
+    timestamp = int(time.time())
+    for chain_id in sorted(chains):
+        feed = ChainFeed.load(chain_id)
+        entry = FeedEntry(sequence=feed.sequence + 1, timestamp=timestamp, reset=reset)
+        if not reset:
+            diff_chain(chain_id, previous.get(chain_id, []), current.get(chain_id, []), policy, entry)
+            if not (entry.added or entry.removed or entry.trust or entry.changed):
+                continue
+        feed.append(entry)
+        sequences[str(chain_id)] = feed.sequence
+        files[feed_path(chain_id)] = feed.to_bytes()
+    if files:
+        files[index_path] = json.dumps({
+            "version": CHANGE_FEED_VERSION,
+            "trustPolicy": fingerprint,
+            "chains": dict(sorted(sequences.items(), key=lambda kv: int(kv[0]))),
+        }, indent=None if MINIFY_OUTPUT else 4).encode()
+    return files
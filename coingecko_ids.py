@@ -1,8 +1,25 @@
+import asyncio
+import json
+import logging
+import time
 from collections import defaultdict
+from typing import Any, Iterable, Optional
 
-import httpx
-
+import http_client
 from common import Address
+from http_cache import CacheEntry, cache
+from json_stream import JSON_ERRORS, STREAM_PARSE_MIN_SIZE, ItemSink, iter_items, streaming_available
+from metrics import current_report
+
+COINGECKO_COINS_LIST_URL = "https://api.coingecko.com/api/v3/coins/list?include_platform=true"
+
+# the coins list barely changes between runs, so within this window it is not even revalidated
+COINGECKO_IDS_TTL = 6 * 60 * 60
+
+# a failed load is retried after this long
+COINGECKO_IDS_RETRY = 5 * 60
+
+log = logging.getLogger(__name__)
 
 CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID = {
     1: 'ethereum', 3: 'ethereum', 4: 'ethereum', 5: 'ethereum', 56: 'binancecoin', 97: 'binancecoin', 100: 'gnosis',
@@ -13,51 +30,151 @@ CHAIN_ID_TO_NATIVE_COIN_COINGECKO_ID = {
     288: 'ethereum'
 }
 
-def get_coingecko_ids() -> dict[str, dict[Address, str]]:
-    chain_id_to_coingecko_platform = {
-        "1284": "moonbeam",
-        "361": "theta",
-        "592": "astar",
-        "70": "hoo-smart-chain",
-        "122": "fuse",
-        "42262": "oasis",
-        "128": "huobi-token",
-        "321": "kucoin-community-chain",
-        "42161": "arbitrum-one",
-        "1088": "metis-andromeda",
-        "56": "binance-smart-chain",
-        "66": "okex-chain",
-        "250": "fantom",
-        "88": "tomochain",
-        "82": "meter",
-        "1818": "cube-network",
-        "42220": "celo",
-        "10": "optimistic-ethereum",
-        "137": "polygon-pos",
-        "43114": "avalanche",
-        "1285": "moonriver",
-        "25": "cronos",
-        "288": "boba",
-        "10000": "smartbch",
-        "1313161554": "aurora",
-        "1666600000": "harmony-shard-0",
-        "100": "xdai",
-        "1": "ethereum",
-        "32659": "fusion-network",
-        "40": "telos",
-        "-1": "solana",
-        "9001": "evmos"
-    }
-    coingecko_platform_to_chain_id = {v: k for k, v in chain_id_to_coingecko_platform.items()}
-    coins = httpx.get('https://api.coingecko.com/api/v3/coins/list', params={'include_platform': True}).json()
+CHAIN_ID_TO_COINGECKO_PLATFORM = {
+    "1284": "moonbeam",
+    "361": "theta",
+    "592": "astar",
+    "70": "hoo-smart-chain",
+    "122": "fuse",
+    "42262": "oasis",
+    "128": "huobi-token",
+    "321": "kucoin-community-chain",
+    "42161": "arbitrum-one",
+    "1088": "metis-andromeda",
+    "56": "binance-smart-chain",
+    "66": "okex-chain",
+    "250": "fantom",
+    "88": "tomochain",
+    "82": "meter",
+    "1818": "cube-network",
+    "42220": "celo",
+    "10": "optimistic-ethereum",
+    "137": "polygon-pos",
+    "43114": "avalanche",
+    "1285": "moonriver",
+    "25": "cronos",
+    "288": "boba",
+    "10000": "smartbch",
+    "1313161554": "aurora",
+    "1666600000": "harmony-shard-0",
+    "100": "xdai",
+    "1": "ethereum",
+    "32659": "fusion-network",
+    "40": "telos",
+    "-1": "solana",
+    "9001": "evmos"
+}
+
+COINGECKO_PLATFORM_TO_CHAIN_ID = {v: k for k, v in CHAIN_ID_TO_COINGECKO_PLATFORM.items()}
+
+
+def _add_coin(res: dict[str, dict[Address, str]], coin: dict) -> None:
+    if not coin['id']:
+        return
+    for platform, address in coin.get('platforms', {}).items():
+        if platform and address and platform in COINGECKO_PLATFORM_TO_CHAIN_ID:
+            res[COINGECKO_PLATFORM_TO_CHAIN_ID[platform]][address.lower()] = coin['id']
+
+
+def _build_coingecko_ids(coins: Iterable[dict]) -> dict[str, dict[Address, str]]:
     res: dict[str, dict[Address, str]] = defaultdict(dict)
     for coin in coins:
-        if not coin['id']:
-            continue
-        for platform, address in coin.get('platforms', {}).items():
-            if platform and address and platform in coingecko_platform_to_chain_id:
-                res[coingecko_platform_to_chain_id[platform]][address.lower()] = coin['id']
+        _add_coin(res, coin)
     return res
 
 
-coingecko_ids = get_coingecko_ids()
+class CoingeckoIdsSink(ItemSink):
+    # the index is built from the coins list while it downloads, the list itself is never decoded whole
+    def __init__(self):
+        super().__init__([])
+        self.coingecko_ids: dict[str, dict[Address, str]] = defaultdict(dict)
+
+    def reset(self) -> None:
+        self.coingecko_ids = defaultdict(dict)
+
+    def add_item(self, item: Any) -> None:
+        _add_coin(self.coingecko_ids, item)
+
+
+_coingecko_ids_hash: Optional[str] = None
+
+
+async def _load_coingecko_ids() -> dict[str, dict[Address, str]]:
+    global _coingecko_ids_hash
+    metrics = current_report().fetch("coingecko_ids", COINGECKO_COINS_LIST_URL, [])
+    sink = CoingeckoIdsSink() if streaming_available() else None
+    entry = await http_client.fetch_entry(
+        COINGECKO_COINS_LIST_URL, ttl=COINGECKO_IDS_TTL, metrics=metrics, sink=sink
+    )
+    if entry is None:
+        # publishing every token without its coingeckoId is worse than not publishing
+        raise RuntimeError(f"coingecko ids unavailable: {COINGECKO_COINS_LIST_URL} failed and isn't cached")
+    if sink is not None and sink.complete:
+        # a fresh download, indexed as it arrived
+        cache.put_derived(entry, "coingecko_ids", sink.coingecko_ids)
+        _coingecko_ids_hash = entry.content_hash
+        return sink.coingecko_ids
+    try:
+        coingecko_ids = _entry_coingecko_ids(entry)
+    except JSON_ERRORS as e:
+        # a new coins list that isn't json never replaces the cached one
+        cache.discard(entry)
+        cached = cache.get(COINGECKO_COINS_LIST_URL) if entry.pending_path is not None else None
+        if cached is None:
+            raise RuntimeError(f"coingecko ids unavailable: {COINGECKO_COINS_LIST_URL} can't be decoded: {e!r}")
+        log.warning(f"{COINGECKO_COINS_LIST_URL} can't be decoded: {e!r}, using the cached coins list")
+        metrics.error = repr(e)
+        metrics.stale = True
+        return _entry_coingecko_ids(cached)
+    cache.commit(entry)
+    return coingecko_ids
+
+
+def _entry_coingecko_ids(entry: CacheEntry) -> dict[str, dict[Address, str]]:
+    global _coingecko_ids_hash
+    coingecko_ids = cache.get_derived(entry, "coingecko_ids")
+    if coingecko_ids is None:
+        if streaming_available() and entry.size >= STREAM_PARSE_MIN_SIZE:
+            with cache.open_body(entry) as f:
+                coingecko_ids = _build_coingecko_ids(iter_items(f, []))
+        else:
+            coingecko_ids = _build_coingecko_ids(json.loads(cache.read_body(entry)))
+        cache.put_derived(entry, "coingecko_ids", coingecko_ids)
+    _coingecko_ids_hash = entry.content_hash
+    return coingecko_ids
+
+
+def cached_coingecko_ids() -> dict[str, dict[Address, str]]:
+    # the index of the last coins list that was downloaded, without touching the network
+    entry = cache.get(COINGECKO_COINS_LIST_URL)
+    if entry is None:
+        raise RuntimeError(f"coingecko ids unavailable: {COINGECKO_COINS_LIST_URL} isn't cached")
+    return _entry_coingecko_ids(entry)
+
+
+_coingecko_ids_task: Optional[asyncio.Task] = None
+
+_coingecko_ids_started = 0.0
+
+
+def get_coingecko_ids() -> asyncio.Task:
+    # started once and shared, so the index is built while providers are still downloading;
+    # a long running process gets a new one once the coins list may have changed, or a while after a failure
+    global _coingecko_ids_task, _coingecko_ids_started
+    if (
+        _coingecko_ids_task is None
+        or _coingecko_ids_task.get_loop() is not asyncio.get_running_loop()
+        or (_coingecko_ids_task.done() and time.monotonic() - _coingecko_ids_started > (
+            COINGECKO_IDS_RETRY
+            if _coingecko_ids_task.cancelled() or _coingecko_ids_task.exception() is not None
+            else COINGECKO_IDS_TTL
+        ))
+    ):
+        _coingecko_ids_task = asyncio.ensure_future(_load_coingecko_ids())
+        _coingecko_ids_started = time.monotonic()
+    return _coingecko_ids_task
+
+
+def get_coingecko_ids_hash() -> Optional[str]:
+    # hash of the coins list the current index was built from
+    return _coingecko_ids_hash
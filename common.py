@@ -1,8 +1,15 @@
-from typing import NewType, Optional, TypedDict
+import re
+import sys
+from functools import lru_cache
+from typing import Any, NewType, Optional, TypedDict, TypeVar
 
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, validator
 from web3 import Web3
 
+TOKENLISTS_FOLDER = "tokenlists"
+
+ALL_TOKENS_FOLDER = "all_tokens"
+
 CHAIN_NAMES_BY_ID = {
     '1': 'ethereum',
     '10': 'optimism',
@@ -57,38 +64,126 @@ Address = NewType('Address', str)
 ChainId = NewType('ChainId', int)
 
 
+_HEX_ADDRESS_RE = re.compile(r"(0[xX])?[0-9a-fA-F]{40}")
+
+
+@lru_cache(maxsize=None)
+def _to_checksum_address(lowercase_address: str) -> str:
+    return Web3.toChecksumAddress(lowercase_address)
+
+
+def checksum_address(v: str) -> str:
+    # same result as Web3.isAddress + Web3.toChecksumAddress, but hashes every address only once per run
+    v = v.strip()
+    if _HEX_ADDRESS_RE.fullmatch(v) is None:
+        return v
+    hex_part = v[-40:]
+    checksummed = _to_checksum_address(f"0x{hex_part.lower()}")
+    if hex_part.islower() or hex_part.isupper() or hex_part.isdigit() or checksummed == v:
+        return checksummed
+    # mixed case is only an address for web3 with a correct checksum and a 0x prefix
+    return v
+
+
 class Token(BaseModel):
     symbol: str
     name: str
     address: Address
-    decimals: int = Field(..., alias="tokenDecimal")
+    decimals: int
     chainId: ChainId
     logoURI: Optional[str]
     coingeckoId: Optional[str]
     listedIn: list[str] = []
 
-    class Config:
-        allow_population_by_field_name = True
-
-    def __init__(self, **data):
-        super().__init__(
-            logoURI=(
-                data.pop("logoURI", None) or data.pop("logo", None) or data.pop("icon", None) or data.pop("image", None)
-            ),
-            **data,
-        )
-
     # if logo.startswith('//'):
     # logo = 'ht
 
     @validator("address")
     def addr_checksum(cls, v: str):
-        v = v.strip()
-        if Web3.isAddress(v):
-            if "#" in v:
-                v = v.split("#")[0]
-            return Web3.toChecksumAddress(v)
-        return v
+        return checksum_address(v)
+
+    @classmethod
+    def from_raw(cls, data: dict[str, Any]) -> "Token":
+        # data has the fields of a token, as normalized by a provider's extractor; tokenlists almost always
+        # have well-typed fields, those skip pydantic validation entirely
+        symbol = data.get("symbol")
+        name = data.get("name")
+        address = data.get("address")
+        decimals = data.get("decimals")
+        chain_id = data.get("chainId")
+        logo = data.get("logoURI") or None
+        coingecko_id = data.get("coingeckoId")
+        if (
+            type(symbol) is str and type(name) is str and type(address) is str and type(decimals) is int
+            and type(chain_id) is int and (logo is None or type(logo) is str)
+            and (coingecko_id is None or type(coingecko_id) is str)
+        ):
+            return cls.construct(
+                symbol=symbol,
+                name=name,
+                address=Address(checksum_address(address)),
+                decimals=decimals,
+                chainId=ChainId(chain_id),
+                logoURI=logo,
+                coingeckoId=coingecko_id,
+                listedIn=[],
+            )
+        return cls.parse_obj({**data, "logoURI": logo})
+
+
+_Record = TypeVar("_Record", bound="TokenRecord")
+
+
+def _intern(v: Optional[str]) -> Optional[str]:
+    return sys.intern(v) if v is not None else None
+
+
+class TokenRecord:
+    # compact counterpart of Token used while merging: no per-instance __dict__, and the strings
+    # repeated across providers and chains (symbols, names, logos, provider names) are interned
+    __slots__ = ("symbol", "name", "address", "decimals", "chainId", "logoURI", "coingeckoId", "listedIn")
+
+    def __init__(
+        self,
+        symbol: str,
+        name: str,
+        address: Address,
+        decimals: int,
+        chainId: ChainId,
+        logoURI: Optional[str] = None,
+        coingeckoId: Optional[str] = None,
+        listedIn: Optional[list[str]] = None,
+    ):
+        self.symbol = sys.intern(symbol)
+        self.name = sys.intern(name)
+        self.address = address
+        self.decimals = decimals
+        self.chainId = chainId
+        self.logoURI = _intern(logoURI)
+        self.coingeckoId = _intern(coingeckoId)
+        self.listedIn = [sys.intern(p) for p in listedIn] if listedIn else []
+
+    @classmethod
+    def from_token(cls: type[_Record], token: Token) -> _Record:
+        return cls(
+            token.symbol, token.name, token.address, token.decimals, token.chainId, token.logoURI, token.coingeckoId,
+            token.listedIn,
+        )
+
+    def to_token(self) -> Token:
+        return Token.construct(**self.dict())
+
+    def dict(self) -> dict[str, Any]:
+        return {
+            "symbol": self.symbol,
+            "name": self.name,
+            "address": self.address,
+            "decimals": self.decimals,
+            "chainId": self.chainId,
+            "logoURI": self.logoURI,
+            "coingeckoId": self.coingeckoId,
+            "listedIn": list(self.listedIn),
+        }
 
 
 NATIVE_ADDR_0xe = "0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee"
@@ -21,6 +21,32 @@ or
 
 https://raw.githubusercontent.com/viaprotocol/tokenlists/main/tokenlists/bsc.json (Binance Smart Chain Tokenlist)
 
+All chains at once are in `all.json`, which is also published precompressed (`all.json.gz`, `all.json.br`) and as
+compact MessagePack (`all.msgpack`). Any of them can be read back with `tokenlist_loader.py`:
+```python
+from tokenlist_loader import load_all
+tokens_by_chain = load_all("tokenlists/all.msgpack")
+```
+
+For lookups from Python, `token_registry.TokenRegistry` loads a chain only when it is first used and indexes it by
+address, symbol and coingecko id:
+```python
+from token_registry import TokenRegistry
+usdt = TokenRegistry().get("bsc", "0x55d398326f99059ff775485246999027b3197955")
+```
+
+Every folder also has a symbol and name search index, `search.msgpack`, matching by prefix and, for typos, by
+trigrams:
+```python
+from token_search import SearchIndex
+hits = SearchIndex.load("tokenlists/search.msgpack").search("usd", chain_id=56)
+```
+
+To follow updates without reloading whole lists, `changes/{{chain}}.json` logs what every run changed on a chain: tokens
+added and removed, trust changes (`listedIn` and tiers) and field changes, each entry numbered by a sequence that
+only grows. `changes/index.json` has the latest sequence of every chain; a consumer applies the entries after the
+sequence it has, and reloads the chain's list when an entry is a `reset` or its sequence is older than the log.
+
 ## Providers
 
 We collect tokenlists from github repos or open APIs from various platforms, currently:
@@ -39,6 +65,9 @@ We collect tokenlists from github repos or open APIs from various platforms, cur
 
 Feel free to add new provider if you think it is trusted and if it has opensource tokenlists, on github 
 or in API.
+Providers are declared in `providers.yml`: the url, its chains, and where the tokens are in the response and
+under which keys, so a new provider is usually a few lines of YAML. Installed packages can add providers through the
+`tokenlists.providers` entry point group.
 
 ## Chains with trusted tokens
 
@@ -59,7 +88,9 @@ Testnets:
 
 We collect many tokenlists from many providers, then we aggregate them by chains and tokens addresses. 
 For each token we check whether it is listed in 2 or more tokenlists from different providers. If so, 
-we add it to our trusted tokenlist.
+we add it to our trusted tokenlist. Provider weights, the thresholds of the trusted and other tiers, and which provider's
+logo, name or symbol wins are set in `trust_policy.yml`. With `TOKENLISTS_TIER_DELTAS=1` every tier also gets a
+`deltas/<tier>.json` listing the tokens that entered or left it in its last update.
 
 
 ## Run aggregation script yourself
@@ -73,6 +104,26 @@ Run the script from repo root folder
 python generate_readme.py
 ```
 
+## Run as a service
+`tokenlist_daemon.py` keeps the merged tokens in memory, refreshes every provider on its own schedule and serves them
+over HTTP, with ETags and gzip:
+```bash
+python tokenlist_daemon.py  # listens on TOKENLISTS_DAEMON_HOST:TOKENLISTS_DAEMON_PORT, 127.0.0.1:8080 by default
+curl localhost:8080/tokens/bsc  # a chain's tokens, ?tier=all for every tier of trust_policy.yml
+curl localhost:8080/tokens/bsc/0x55d398326f99059ff775485246999027b3197955
+curl "localhost:8080/search?q=usd&chain=bsc"
+```
+
+## Benchmarks
+`benchmark.py` replays provider responses offline, scaled up to larger token counts, and reports time, tokens/s
+and peak memory for downloading, parsing, merging, writing outputs and generating the readme:
+```bash
+python benchmark.py --record  # record live provider responses into benchmarks/fixtures once
+python benchmark.py --scales 1,10,100 --save-baseline
+python benchmark.py --scales 1,10,100  # exits with 1 if a stage regressed, 2 without a baseline
+```
+Urls without a recorded response are served synthetic tokenlists.
+
 
 ## Contribute
 Feel free to open issues and PRs with tokens, chains or providers that you want to add.
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, BinaryIO, Optional
+
+import httpx
+from pydantic import BaseModel
+
+from json_stream import ItemSink
+
+CACHE_FOLDER = os.environ.get("TOKENLISTS_CACHE_FOLDER", ".cache")
+
+HTTP_CACHE_FOLDER = f"{CACHE_FOLDER}/http"
+
+
+class InvalidBody(ValueError):
+    pass
+
+
+class CacheEntry(BaseModel):
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_hash: str
+    size: int = 0
+    fetched_at: float
+    # a downloaded body waits here until it is known to decode, the cached one stays in place meanwhile
+    pending_path: Optional[str] = None
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    def conditional_headers(self) -> dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class HttpCache:
+    def __init__(self, folder: str = HTTP_CACHE_FOLDER):
+        self.folder = folder
+
+    def _path(self, url: str, suffix: str) -> str:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.folder, f"{key}.{suffix}")
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        try:
+            entry = CacheEntry.parse_file(self._path(url, "meta.json"))
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(self._path(url, "body")):
+            return None
+        return entry
+
+    def _body_path(self, entry: CacheEntry) -> str:
+        return entry.pending_path or self._path(entry.url, "body")
+
+    def read_body(self, entry: CacheEntry) -> bytes:
+        with open(self._body_path(entry), "rb") as f:
+            return f.read()
+
+    def open_body(self, entry: CacheEntry) -> BinaryIO:
+        return open(self._body_path(entry), "rb")
+
+    async def put_stream(self, url: str, resp: httpx.Response, sink: Optional[ItemSink] = None) -> CacheEntry:
+        # the body goes to disk chunk by chunk as it downloads, it is never held in memory whole. It is only
+        # committed once it decodes: here when sink decoded it (a body that isn't json raises InvalidBody),
+        # otherwise by whoever parses the pending entry, so the body isn't decoded twice
+        path = self._path(url, "body")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(self.folder, exist_ok=True)
+        content_hash = hashlib.sha256()
+        size = 0
+        if sink is not None:
+            sink.start()
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in resp.aiter_bytes():
+                    f.write(chunk)
+                    content_hash.update(chunk)
+                    size += len(chunk)
+                    if sink is not None:
+                        sink.feed(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if sink is not None:
+            sink.finish()
+            if sink.error is not None:
+                os.remove(tmp_path)
+                raise InvalidBody(f"not json: {sink.error}")
+        entry = CacheEntry(
+            url=url,
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified"),
+            content_hash=content_hash.hexdigest(),
+            size=size,
+            fetched_at=time.time(),
+            pending_path=tmp_path,
+        )
+        return self.commit(entry) if sink is not None else entry
+
+    def commit(self, entry: CacheEntry) -> CacheEntry:
+        # a pending body replaces the cached one
+        if entry.pending_path is None:
+            return entry
+        os.replace(entry.pending_path, self._path(entry.url, "body"))
+        entry = entry.copy(update={"pending_path": None})
+        write_atomic(self._path(entry.url, "meta.json"), entry.json(exclude={"pending_path"}).encode())
+        return entry
+
+    def discard(self, entry: CacheEntry) -> None:
+        # a pending body that didn't decode, the cached one is kept
+        if entry.pending_path is not None:
+            try:
+                os.remove(entry.pending_path)
+            except FileNotFoundError:
+                pass
+
+    def remove(self, url: str) -> None:
+        for suffix in ("meta.json", "body"):
+            try:
+                os.remove(self._path(url, suffix))
+            except FileNotFoundError:
+                pass
+
+    def touch(self, entry: CacheEntry) -> CacheEntry:
+        entry = entry.copy(update={"fetched_at": time.time()})
+        write_atomic(self._path(entry.url, "meta.json"), entry.json(exclude={"pending_path"}).encode())
+        return entry
+
+    # values computed from a body (parsed index, tokens) are only valid while that body is current
+    def get_derived(self, entry: CacheEntry, name: str) -> Optional[Any]:
+        try:
+            with open(self._path(entry.url, f"{name}.json"), "rb") as f:
+                derived = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if derived.get("content_hash") != entry.content_hash:
+            return None
+        return derived["data"]
+
+    def put_derived(self, entry: CacheEntry, name: str, data: Any) -> None:
+        derived = {"content_hash": entry.content_hash, "data": data}
+        write_atomic(self._path(entry.url, f"{name}.json"), json.dumps(derived, ensure_ascii=False).encode())
+
+
+cache = HttpCache()
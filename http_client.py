@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from http_cache import CacheEntry, InvalidBody, cache
+from json_stream import ItemSink
+from metrics import FetchMetrics, RequestTrace
+
+MAX_CONNECTIONS = 64
+
+MAX_KEEPALIVE_CONNECTIONS = 32
+
+MAX_CONNECTIONS_PER_HOST = 6
+
+# requests per second and burst size of every host's token bucket
+DEFAULT_RATE_LIMIT = (50.0, 50)
+
+HOST_RATE_LIMITS = {
+    # the public api allows a few dozen calls a minute
+    "api.coingecko.com": (0.5, 2),
+}
+
+# a fetch that hasn't succeeded by then falls back to the cached response
+FETCH_DEADLINE = float(os.environ.get("TOKENLISTS_FETCH_DEADLINE", 60))
+
+MAX_RETRIES = 5
+
+BACKOFF_BASE = 0.5
+
+BACKOFF_MAX = 30.0
+
+# consecutive failures after which a url is not even tried for the cooldown
+CIRCUIT_BREAKER_THRESHOLD = 5
+
+CIRCUIT_BREAKER_COOLDOWN = 300.0
+
+log = logging.getLogger(__name__)
+
+_client: Optional[httpx.AsyncClient] = None
+
+# replaces the network for every request, e.g. an httpx.MockTransport serving recorded responses
+_transport: Optional[httpx.AsyncBaseTransport] = None
+
+_host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self, seconds: float) -> None:
+        # the host asked us to slow down: every request to it waits, and the rate is halved until it recovers
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+        self.tokens = 0
+
+    def recover(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 8)
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_started: Optional[float] = None
+
+    def allow(self) -> bool:
+        # once the cooldown has passed a single request is let through, the others are refused until it succeeds
+        # and a failure reopens the circuit; a probe that never reported back is given up after a cooldown
+        now = time.monotonic()
+        if self.opened_at is None:
+            return True
+        if now - self.opened_at < CIRCUIT_BREAKER_COOLDOWN:
+            return False
+        if self.probe_started is not None and now - self.probe_started < CIRCUIT_BREAKER_COOLDOWN:
+            return False
+        self.probe_started = now
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.probe_started = None
+        if self.failures >= CIRCUIT_BREAKER_THRESHOLD:
+            self.opened_at = time.monotonic()
+
+
+_host_buckets: dict[str, TokenBucket] = {}
+
+# per url, a host serves many providers and one broken url shouldn't block the others
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            transport=_transport,
+        )
+    return _client
+
+
+def set_transport(transport: Optional[httpx.AsyncBaseTransport]) -> None:
+    # takes effect for the next client, so call it before any request or after close_client()
+    global _transport
+    _transport = transport
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+    _client = None
+    _host_semaphores.clear()
+    _host_buckets.clear()
+    _breakers.clear()
+
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    host = urlsplit(url).netloc
+    if host not in _host_semaphores:
+        _host_semaphores[host] = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+    return _host_semaphores[host]
+
+
+def _host_bucket(host: str) -> TokenBucket:
+    if host not in _host_buckets:
+        _host_buckets[host] = TokenBucket(*HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+    return _host_buckets[host]
+
+
+def _breaker(url: str) -> CircuitBreaker:
+    if url not in _breakers:
+        _breakers[url] = CircuitBreaker()
+    return _breakers[url]
+
+
+async def get(url: str, **kwargs) -> httpx.Response:
+    async with _host_semaphore(url):
+        await _host_bucket(urlsplit(url).netloc).acquire()
+        return await get_client().get(url, **kwargs)
+
+
+async def get_cached(
+    url: str, ttl: float = 0, sink: Optional[ItemSink] = None, **kwargs
+) -> tuple[Optional[httpx.Response], Optional[CacheEntry]]:
+    # a 200 body is streamed into the cache, and into sink while it downloads
+    entry = cache.get(url)
+    if entry is not None and entry.age < ttl:
+        return None, entry
+
+    headers = kwargs.pop("headers", {})
+    if entry is not None:
+        headers = {**entry.conditional_headers(), **headers}
+    async with _host_semaphore(url):
+        await _host_bucket(urlsplit(url).netloc).acquire()
+        async with get_client().stream("GET", url, headers=headers, **kwargs) as resp:
+            if resp.status_code == 304 and entry is not None:
+                return resp, cache.touch(entry)
+            if resp.status_code == 200:
+                return resp, await cache.put_stream(url, resp, sink)
+            return resp, None
+
+
+def _retry_delay(attempt: int, resp: Optional[httpx.Response]) -> float:
+    # full jitter, unless the server said how long to wait
+    retry_after = resp.headers.get("Retry-After") if resp is not None else None
+    if retry_after is not None and retry_after.isdigit():
+        return int(retry_after) + random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+async def fetch_entry(
+    url: str,
+    ttl: float = 0,
+    deadline: float = FETCH_DEADLINE,
+    metrics: Optional[FetchMetrics] = None,
+    sink: Optional[ItemSink] = None,
+) -> Optional[CacheEntry]:
+    # retries transport errors, 429 and 5xx until the deadline, then falls back to the last good response
+    host = urlsplit(url).netloc
+    bucket = _host_bucket(host)
+    breaker = _breaker(url)
+    started = time.monotonic()
+    error = None
+    attempt = 0
+    while True:
+        remaining = deadline - (time.monotonic() - started)
+        if not breaker.allow():
+            error = "too many failures, not retried before the cooldown"
+            break
+        trace = RequestTrace()
+        try:
+            resp, entry = await asyncio.wait_for(get_cached(url, ttl, sink, extensions={"trace": trace}), remaining)
+        except (httpx.TransportError, asyncio.TimeoutError) as e:
+            resp, entry, error = None, None, repr(e)
+        except InvalidBody as e:
+            # served with a 200, so retrying right away rarely helps
+            error = str(e)
+            breaker.record_failure()
+            break
+        else:
+            if metrics is not None:
+                body_size = entry.size if entry is not None and resp is not None and resp.status_code == 200 else 0
+                metrics.add_response(resp, trace, body_size)
+            if entry is not None:
+                breaker.record_success()
+                bucket.recover()
+                return entry
+            # only a fresh cached entry comes without a response
+            assert resp is not None
+            error = f"status {resp.status_code}"
+            if resp.status_code != 429 and resp.status_code < 500:
+                break
+
+        breaker.record_failure()
+        attempt += 1
+        delay = _retry_delay(attempt, resp)
+        if attempt > MAX_RETRIES or delay >= deadline - (time.monotonic() - started):
+            break
+        if resp is not None and resp.status_code == 429:
+            bucket.throttle(delay)
+        if metrics is not None:
+            metrics.retries = attempt
+            metrics.retry_after_seconds += delay
+        log.info(f"{url} failed with {error}, retry {attempt} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    if metrics is not None:
+        metrics.error = error
+    entry = cache.get(url)
+    if entry is None:
+        log.error(f"failed to get {url}: {error}")
+        return None
+    log.warning(f"failed to get {url}: {error}, using the response cached {entry.age / 3600:.1f}h ago")
+    if metrics is not None:
+        metrics.stale = True
+    return entry
@@ -0,0 +1,90 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Any, BinaryIO, Generator, Iterator, Optional
+
+try:
+    import ijson  # type: ignore[import]
+except ImportError:
+    ijson = None
+
+# what decoding a malformed body raises, whole or streamed
+JSON_ERRORS: tuple[type[Exception], ...] = (ValueError,) if ijson is None else (ValueError, ijson.JSONError)
+
+# bodies at least this large are parsed item by item instead of decoded whole, when ijson is installed
+STREAM_PARSE_MIN_SIZE = int(os.environ.get("TOKENLISTS_STREAM_PARSE_MIN_SIZE", 4 * 1024 * 1024))
+
+
+def streaming_available() -> bool:
+    return ijson is not None
+
+
+def item_prefix(path: list[str]) -> str:
+    # ijson prefix of the values of the object or items of the array at path
+    return ".".join(path + ["item"])
+
+
+def iter_items(f: BinaryIO, path: list[str]) -> Iterator[Any]:
+    # items of the array at path, decoded one at a time
+    return ijson.items(f, item_prefix(path), use_float=True)
+
+
+def iter_kvitems(f: BinaryIO, path: list[str]) -> Iterator[tuple[str, Any]]:
+    # keys and values of the object at path, decoded one at a time
+    return ijson.kvitems(f, ".".join(path), use_float=True)
+
+
+class ItemSink(ABC):
+    # fed a response body chunk by chunk while it downloads, hands every item of the array at path to add_item
+    # as soon as it is complete; start() is called again when a failed download is retried
+    def __init__(self, path: list[str]):
+        self.prefix = item_prefix(path)
+        self.complete = False
+        self.error: Optional[Exception] = None
+        self._items: list[Any] = []
+        self._coro: Optional[Generator[None, bytes, None]] = None
+
+    def start(self) -> None:
+        self.complete = False
+        self.error = None
+        self._items = ijson.sendable_list()
+        self._coro = ijson.items_coro(self._items, self.prefix, use_float=True)
+        self.reset()
+
+    def feed(self, chunk: bytes) -> None:
+        if self.error is not None:
+            return
+        if self._coro is None:
+            raise RuntimeError(f"{type(self).__name__} fed before start()")
+        try:
+            self._coro.send(chunk)
+        except ijson.JSONError as e:
+            # the body isn't cached, the previous one is kept
+            self.error = e
+            return
+        self._drain()
+
+    def finish(self) -> None:
+        if self.error is not None:
+            return
+        if self._coro is None:
+            raise RuntimeError(f"{type(self).__name__} finished before start()")
+        try:
+            self._coro.close()
+        except ijson.JSONError as e:
+            self.error = e
+            return
+        self._drain()
+        self.complete = True
+
+    def _drain(self) -> None:
+        for item in self._items:
+            self.add_item(item)
+        del self._items[:]
+
+    def reset(self) -> None:
+        # drop what a previous, failed download added
+        pass
+
+    @abstractmethod
+    def add_item(self, item: Any) -> None:
+        pass
@@ -0,0 +1,205 @@
+import contextvars
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Any, Optional
+
+import httpx
+from pydantic import BaseModel
+
+from http_cache import CACHE_FOLDER, write_atomic
+
+REPORT_PATH = os.environ.get("TOKENLISTS_REPORT_PATH", f"{CACHE_FOLDER}/run_report.json")
+
+# written only when set, e.g. for node_exporter's textfile collector
+PROMETHEUS_PATH = os.environ.get("TOKENLISTS_PROMETHEUS_PATH")
+
+log = logging.getLogger(__name__)
+
+
+def _label(value: str) -> str:
+    # label values are quoted, see the prometheus text exposition format
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RequestTrace:
+    # httpcore "trace" extension callback; dns resolution is part of connect_tcp
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.connect_seconds = 0.0
+        self.ttfb_seconds: Optional[float] = None
+        self._connect_started = 0.0
+
+    async def __call__(self, event: str, info: dict[str, Any]) -> None:
+        now = time.perf_counter()
+        if event in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            self._connect_started = now
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self.connect_seconds += now - self._connect_started
+        elif event.endswith("receive_response_headers.complete"):
+            self.ttfb_seconds = now - self.started
+
+
+class FetchMetrics(BaseModel):
+    provider: str
+    url: str
+    chains: list[str] = []
+    started_at: float
+    status: Optional[int]
+    from_cache: bool = False
+    # the fetch failed and a previously cached response was used
+    stale: bool = False
+    connect_seconds: float = 0
+    ttfb_seconds: Optional[float]
+    download_seconds: float = 0
+    total_seconds: float = 0
+    bytes: int = 0
+    retries: int = 0
+    retry_after_seconds: float = 0
+    decode_seconds: float = 0
+    tokens: int = 0
+    parse_failures: int = 0
+    error: Optional[str]
+
+    def add_response(self, resp: Optional[httpx.Response], trace: RequestTrace, body_size: int = 0) -> None:
+        # body_size is what was streamed to the cache, bodies of other responses aren't read
+        elapsed = time.perf_counter() - trace.started
+        self.total_seconds += elapsed
+        self.connect_seconds += trace.connect_seconds
+        if resp is None:
+            self.from_cache = True
+            return
+        self.status = resp.status_code
+        self.from_cache = resp.status_code == 304
+        self.bytes += body_size
+        if trace.ttfb_seconds is not None:
+            self.ttfb_seconds = trace.ttfb_seconds
+            self.download_seconds += elapsed - trace.ttfb_seconds
+
+
+class MergeMetrics(BaseModel):
+    provider: str
+    chain_id: int
+    tokens: int = 0
+    seconds: float = 0
+
+
+class RunReport(BaseModel):
+    started_at: float
+    duration_seconds: float = 0
+    fetches: list[FetchMetrics] = []
+    merges: list[MergeMetrics] = []
+    chains_changed: int = 0
+    files_written: int = 0
+    deadline_exceeded: bool = False
+    # "provider:chain" of every input that came from a cached response instead of a fresh fetch
+    stale_inputs: list[str] = []
+
+    def fetch(self, provider: str, url: str, chains: list[str]) -> FetchMetrics:
+        metrics = FetchMetrics(provider=provider, url=url, chains=chains, started_at=time.time())
+        self.fetches.append(metrics)
+        return metrics
+
+    def mark_stale(self, provider: str, url: str, chains: list[str], reason: str) -> None:
+        for metrics in self.fetches:
+            if metrics.provider == provider and metrics.url == url:
+                break
+        else:
+            metrics = self.fetch(provider, url, chains)
+        metrics.stale = True
+        metrics.error = reason
+
+    def add_merge(self, provider: str, chain_id: int, tokens: int, seconds: float) -> None:
+        for merge in self.merges:
+            if merge.provider == provider and merge.chain_id == chain_id:
+                break
+        else:
+            merge = MergeMetrics(provider=provider, chain_id=chain_id)
+            self.merges.append(merge)
+        merge.tokens += tokens
+        merge.seconds += seconds
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# TYPE tokenlists_run_duration_seconds gauge",
+            f"tokenlists_run_duration_seconds {self.duration_seconds}",
+            "# TYPE tokenlists_chains_changed gauge",
+            f"tokenlists_chains_changed {self.chains_changed}",
+            "# TYPE tokenlists_files_written gauge",
+            f"tokenlists_files_written {self.files_written}",
+            "# TYPE tokenlists_deadline_exceeded gauge",
+            f"tokenlists_deadline_exceeded {int(self.deadline_exceeded)}",
+            "# TYPE tokenlists_stale_inputs gauge",
+            f"tokenlists_stale_inputs {len(self.stale_inputs)}",
+        ]
+        fetch_metrics = {
+            "fetch_seconds": "total_seconds",
+            "fetch_connect_seconds": "connect_seconds",
+            "fetch_download_seconds": "download_seconds",
+            "fetch_bytes": "bytes",
+            "fetch_retries": "retries",
+            "fetch_retry_after_seconds": "retry_after_seconds",
+            "decode_seconds": "decode_seconds",
+            "tokens": "tokens",
+            "parse_failures": "parse_failures",
+        }
+        for name, field in fetch_metrics.items():
+            lines.append(f"# TYPE tokenlists_{name} gauge")
+            for f in self.fetches:
+                labels = f'provider="{_label(f.provider)}",url="{_label(f.url)}"'
+                lines.append(f"tokenlists_{name}{{{labels}}} {getattr(f, field)}")
+        merge_seconds: dict[str, float] = defaultdict(float)
+        for m in self.merges:
+            merge_seconds[m.provider] += m.seconds
+        lines.append("# TYPE tokenlists_merge_seconds gauge")
+        for provider, seconds in merge_seconds.items():
+            lines.append(f'tokenlists_merge_seconds{{provider="{_label(provider)}"}} {seconds}')
+        return "\n".join(lines) + "\n"
+
+    def export_spans(self) -> None:
+        try:
+            from opentelemetry import trace  # type: ignore[import]
+        except ImportError:
+            return
+        tracer = trace.get_tracer("tokenlists")
+        run_span = tracer.start_span("aggregate", start_time=int(self.started_at * 1e9))
+        context = trace.set_span_in_context(run_span)
+        for f in self.fetches:
+            span = tracer.start_span(
+                f"fetch {f.provider}",
+                context=context,
+                start_time=int(f.started_at * 1e9),
+                attributes={"http.url": f.url, "http.status_code": f.status or 0, "tokens": f.tokens},
+            )
+            span.end(end_time=int((f.started_at + f.total_seconds + f.decode_seconds) * 1e9))
+        run_span.end(end_time=int((self.started_at + self.duration_seconds) * 1e9))
+
+    def save(self) -> None:
+        self.stale_inputs = sorted({f"{f.provider}:{chain}" for f in self.fetches if f.stale for chain in f.chains})
+        write_atomic(REPORT_PATH, self.json(indent=4).encode())
+        if PROMETHEUS_PATH:
+            write_atomic(PROMETHEUS_PATH, self.to_prometheus().encode())
+        self.export_spans()
+        slowest = sorted(self.fetches, key=lambda f: f.total_seconds + f.decode_seconds, reverse=True)[:3]
+        log.info(
+            f"run took {self.duration_seconds:.1f}s, slowest: "
+            + ", ".join(f"{f.provider} {f.total_seconds + f.decode_seconds:.1f}s" for f in slowest)
+        )
+
+
+_current_report: contextvars.ContextVar[RunReport] = contextvars.ContextVar("run_report")
+
+
+def start_run() -> RunReport:
+    report = RunReport(started_at=time.time())
+    _current_report.set(report)
+    return report
+
+
+def current_report() -> RunReport:
+    # outside of an aggregation run metrics are collected into a throwaway report
+    report = _current_report.get(None)
+    if report is None:
+        report = start_run()
+    return report
@@ -0,0 +1,104 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+from typing import Any, Iterable
+
+import brotli  # type: ignore[import]
+
+from common import TokenRecord
+from http_cache import write_atomic
+
+MINIFY_OUTPUT = os.environ.get("TOKENLISTS_MINIFY_OUTPUT", "") == "1"
+
+# every tier gets a {tier}.json in DELTAS_FOLDER with the tokens that entered or left it in its last update
+TIER_DELTAS = os.environ.get("TOKENLISTS_TIER_DELTAS", "") == "1"
+
+# kept apart from the tier folders, where every json file is a chain
+DELTAS_FOLDER = os.environ.get("TOKENLISTS_DELTAS_FOLDER", "deltas")
+
+INDENT = b"    "
+
+log = logging.getLogger(__name__)
+
+
+_dumps = json.JSONEncoder(ensure_ascii=False).encode
+
+_dumps_minified = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+def _encode_field(key: str, value: Any) -> str:
+    if isinstance(value, list):
+        if not value:
+            return f'    "{key}": []'
+        return f'    "{key}": [\n' + ",\n".join(f"        {_dumps(v)}" for v in value) + "\n    ]"
+    return f'    "{key}": {_dumps(value)}'
+
+
+def encode_token(token: TokenRecord, minified: bool = MINIFY_OUTPUT) -> bytes:
+    if minified:
+        return _dumps_minified(token.dict()).encode()
+    # same as json.dumps(indent=4), but indent=4 disables the C encoder for the whole token
+    return ("{\n" + ",\n".join(_encode_field(k, v) for k, v in token.dict().items()) + "\n}").encode()
+
+
+def encode_tokens(tokens: Iterable[TokenRecord], minified: bool = MINIFY_OUTPUT) -> list[bytes]:
+    return [encode_token(t, minified) for t in tokens]
+
+
+def _indented(encoded: bytes, level: int) -> bytes:
+    # json escapes newlines inside strings, so every raw newline is structural
+    indent = INDENT * level
+    return indent + encoded.replace(b"\n", b"\n" + indent)
+
+
+# both build exactly what json.dump(..., indent=4) would, from tokens encoded once by encode_token
+def chain_file(encoded_tokens: list[bytes], minified: bool = MINIFY_OUTPUT) -> bytes:
+    if minified:
+        return b"[" + b",".join(encoded_tokens) + b"]"
+    if not encoded_tokens:
+        return b"[]"
+    return b"[\n" + b",\n".join(_indented(t, 1) for t in encoded_tokens) + b"\n]"
+
+
+def all_file(chain_files: dict[int, bytes], minified: bool = MINIFY_OUTPUT) -> bytes:
+    # a chain's list in all.json is its chain file one level deeper, so unchanged chain files can be reused as is
+    if minified:
+        return b"{" + b",".join(b'"%d":' % chain_id + data for chain_id, data in chain_files.items()) + b"}"
+    if not chain_files:
+        return b"{}"
+    return b"{\n" + b",\n".join(
+        b'%s"%d": %s' % (INDENT, chain_id, data.replace(b"\n", b"\n" + INDENT)) for chain_id, data in chain_files.items()
+    ) + b"\n}"
+
+
+# quality 11 is ~100x slower on all.json for a few percent smaller output
+BROTLI_QUALITY = 9
+
+
+def compressed(path: str, data: bytes) -> dict[str, bytes]:
+    # mtime=0 keeps the gzip output stable, so unchanged lists don't produce new files
+    return {
+        f"{path}.gz": gzip.compress(data, compresslevel=9, mtime=0),
+        f"{path}.br": brotli.compress(data, quality=BROTLI_QUALITY),
+    }
+
+
+def _write_if_changed(path: str, data: bytes) -> bool:
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    return False
+    except OSError:
+        pass
+    write_atomic(path, data)
+    return True
+
+
+async def write_files(files: dict[str, bytes]) -> list[str]:
+    written = await asyncio.gather(*[asyncio.to_thread(_write_if_changed, path, data) for path, data in files.items()])
+    changed = [path for path, was_written in zip(files, written) if was_written]
+    log.info(f"{len(changed)} of {len(files)} files changed")
+    return changed
@@ -0,0 +1,45 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+# "process", "thread" or "inline", a process pool only pays off with more than one core
+PARSE_EXECUTOR = os.environ.get("TOKENLISTS_PARSE_EXECUTOR", "process" if (os.cpu_count() or 1) > 1 else "inline")
+
+PARSE_WORKERS = int(os.environ.get("TOKENLISTS_PARSE_WORKERS", 0)) or os.cpu_count() or 1
+
+# smaller payloads parse faster than they can be shipped to a worker
+PARSE_IN_EXECUTOR_MIN_SIZE = 256 * 1024
+
+T = TypeVar("T")
+
+_executor: Optional[Executor] = None
+
+
+def get_executor() -> Optional[Executor]:
+    global _executor
+    if _executor is None:
+        if PARSE_EXECUTOR == "process":
+            # forking a process that runs an event loop and threads can copy a lock some thread holds
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _executor = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context(start_method)
+            )
+        elif PARSE_EXECUTOR == "thread":
+            _executor = ThreadPoolExecutor(max_workers=PARSE_WORKERS, thread_name_prefix="parse")
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+
+
+async def run(size: int, fn: Callable[..., T], *args) -> T:
+    executor = get_executor()
+    if executor is None or size < PARSE_IN_EXECUTOR_MIN_SIZE:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
@@ -0,0 +1,152 @@
+import hashlib
+import os
+import sys
+from importlib.metadata import entry_points
+from typing import Any, BinaryIO, Callable, Iterator, Literal, Optional, Union
+
+import yaml
+from pydantic import BaseModel, validator
+
+from json_stream import iter_items, iter_kvitems
+
+PROVIDERS_PATH = os.environ.get("TOKENLISTS_PROVIDERS", "providers.yml")
+
+# installed packages can add providers: an entry point in this group resolves to a provider spec as a dict
+PROVIDERS_ENTRY_POINT_GROUP = "tokenlists.providers"
+
+# fields of common.Token a response is normalized to
+TOKEN_FIELDS = ("symbol", "name", "address", "decimals", "chainId", "logoURI", "coingeckoId")
+
+# keys a field is read from when a provider doesn't declare its own, tried in order: the alternatives every
+# provider's tokens have always been accepted under
+DEFAULT_FIELDS = {
+    "decimals": ["decimals", "tokenDecimal"],
+    "logoURI": ["logoURI", "logo", "icon", "image"],
+}
+
+Normalizer = Callable[[dict[str, Any]], dict[str, Any]]
+
+
+def _key(key: str) -> Callable[[dict[str, Any]], Any]:
+    def get(raw: dict[str, Any]) -> Any:
+        return raw.get(key)
+
+    return get
+
+
+def _first_set(keys: list[str]) -> Callable[[dict[str, Any]], Any]:
+    # the first key with a value, for fields a provider fills under different keys
+    def get(raw: dict[str, Any]) -> Any:
+        for key in keys:
+            value = raw.get(key)
+            if value is not None and value != "":
+                return value
+        return None
+
+    return get
+
+
+class Extractor(BaseModel):
+    # keys leading from the decoded response to its tokens, "{chain_id}" is replaced by the chain being parsed
+    path: list[str] = []
+    # the tokens are the values of an object, and its keys are put in key_field when set
+    values: bool = False
+    key_field: Optional[str]
+    # token field -> the key it is read from, or keys tried in order, or null to leave it out; fields not
+    # declared are read from DEFAULT_FIELDS or their own name
+    fields: dict[str, Union[None, str, list[str]]] = {}
+    # "own": every token has a chainId, "absent": tokens without one are on the url's chain
+    chain_id: Literal["own", "absent"] = "own"
+
+    @validator("fields")
+    def known_fields(cls, v: dict[str, Union[None, str, list[str]]]):
+        unknown = v.keys() - set(TOKEN_FIELDS)
+        if unknown:
+            raise ValueError(f"unknown token fields {', '.join(sorted(unknown))}")
+        return v
+
+    @property
+    def per_chain(self) -> bool:
+        return any("{chain_id}" in key for key in self.path)
+
+    def source_keys(self, field: str) -> list[str]:
+        keys = self.fields.get(field, DEFAULT_FIELDS.get(field, field))
+        if keys is None:
+            return []
+        return [keys] if isinstance(keys, str) else keys
+
+    def tokens_at(self, response: Any, chain_id: str) -> list[Any]:
+        # raises KeyError or TypeError when the response doesn't have the declared shape
+        raw = response
+        for key in self.path:
+            raw = raw[key.format(chain_id=chain_id)]
+        if not self.values:
+            return raw
+        if self.key_field is None:
+            return list(raw.values())
+        key_field = self.key_field
+        return [dict(v, **{key_field: k}) if isinstance(v, dict) else v for k, v in raw.items()]
+
+    def stream_tokens(self, f: BinaryIO, chain_id: str) -> Iterator[Any]:
+        # what tokens_at returns, decoded from the body one token at a time
+        path = [key.format(chain_id=chain_id) for key in self.path]
+        if not self.values:
+            return iter_items(f, path)
+        if self.key_field is None:
+            return (v for _, v in iter_kvitems(f, path))
+        key_field = self.key_field
+        return (dict(v, **{key_field: k}) if isinstance(v, dict) else v for k, v in iter_kvitems(f, path))
+
+    def compile(self) -> Normalizer:
+        # a copy of the raw token with the declared fields renamed: providers using the token field names pay
+        # only for the copy, the others for their own mapping, and no provider probes keys it doesn't use
+        getters: list[tuple[str, Callable[[dict[str, Any]], Any]]] = []
+        for field in TOKEN_FIELDS:
+            keys = self.source_keys(field)
+            if keys == [field]:
+                continue
+            getters.append((field, _key(keys[0]) if len(keys) == 1 else _first_set(keys)))
+        if not getters:
+            return dict
+
+        def normalize(raw: dict[str, Any]) -> dict[str, Any]:
+            token = dict(raw)
+            for field, get in getters:
+                token[field] = get(raw)
+            return token
+
+        return normalize
+
+
+class ProviderSpec(BaseModel):
+    name: str
+    base_url: str
+    # base_url is formatted with the chain id instead of the chain name
+    by_chain_id: bool = False
+    # chain id -> chain name, as the provider calls it
+    chains: dict[str, str]
+    extract: Extractor = Extractor()
+
+    def fingerprint(self) -> str:
+        return hashlib.sha256(self.json(sort_keys=True).encode()).hexdigest()
+
+
+def plugin_specs() -> list[ProviderSpec]:
+    # entry_points() only selects by group from python 3.10 on
+    if sys.version_info >= (3, 10):
+        eps = entry_points(group=PROVIDERS_ENTRY_POINT_GROUP)
+    else:
+        eps = entry_points().get(PROVIDERS_ENTRY_POINT_GROUP, [])
+    return [ProviderSpec.parse_obj(ep.load()) for ep in eps]
+
+
+def load_provider_specs(path: str = PROVIDERS_PATH) -> list[ProviderSpec]:
+    # providers.yml order is the providers' rank when merging, plugins come after it
+    with open(path, "r") as stream:
+        specs = [ProviderSpec.parse_obj(spec) for spec in yaml.safe_load(stream)["providers"]]
+    specs += plugin_specs()
+    names = [spec.name for spec in specs]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"providers declared more than once: {', '.join(sorted(duplicates))}")
+    return specs
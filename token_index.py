@@ -0,0 +1,97 @@
+import json
+import mmap
+import struct
+from typing import Optional
+
+from common import TokenRecord
+
+# <chain>.idx layout:
+#   header: magic, version, record count
+#   records: 20-byte address, offset and length of the token in the blob, sorted by address
+#   blob: compact json of every token
+INDEX_MAGIC = b"TLIX"
+
+INDEX_VERSION = 1
+
+_HEADER = struct.Struct("<4sHI")
+
+_RECORD = struct.Struct("<20sII")
+
+
+def _address_key(address: str) -> Optional[bytes]:
+    if len(address) != 42 or not address.startswith("0x"):
+        return None
+    try:
+        return bytes.fromhex(address[2:])
+    except ValueError:
+        return None
+
+
+def build_index(tokens: list[TokenRecord]) -> Optional[bytes]:
+    # only evm addresses fit the fixed 20-byte key, chains without any get no index
+    keyed = []
+    for t in tokens:
+        key = _address_key(t.address)
+        if key is not None:
+            keyed.append((key, json.dumps(t.dict(), ensure_ascii=False, separators=(",", ":")).encode()))
+    if not keyed:
+        return None
+    keyed.sort(key=lambda x: x[0])
+
+    records = bytearray()
+    blob = bytearray()
+    for key, encoded in keyed:
+        records += _RECORD.pack(key, len(blob), len(encoded))
+        blob += encoded
+    return _HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(keyed)) + bytes(records) + bytes(blob)
+
+
+class TokenIndex:
+    # lookups binary search the mmapped file, nothing is deserialized except the token that is found,
+    # and every process reading the same file shares one page cache copy
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = _HEADER.unpack_from(self._mm, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{path} is not a version {INDEX_VERSION} token index")
+        self._blob_offset = _HEADER.size + self.count * _RECORD.size
+
+    def close(self) -> None:
+        self._mm.close()
+
+    def __enter__(self) -> "TokenIndex":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _key(self, i: int) -> bytes:
+        start = _HEADER.size + i * _RECORD.size
+        return self._mm[start:start + 20]
+
+    def get_raw(self, address: str) -> Optional[bytes]:
+        key = _address_key(address.lower())
+        if key is None:
+            return None
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count or self._key(lo) != key:
+            return None
+        _, offset, length = _RECORD.unpack_from(self._mm, _HEADER.size + lo * _RECORD.size)
+        start = self._blob_offset + offset
+        return self._mm[start:start + length]
+
+    def get(self, address: str) -> Optional[TokenRecord]:
+        raw = self.get_raw(address)
+        if raw is None:
+            return None
+        return TokenRecord(**json.loads(raw))
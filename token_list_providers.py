@@ -1,13 +1,25 @@
 import asyncio
-import json
 import logging.config
+import time
 from collections import defaultdict
+from typing import Any, Iterable, Optional
 
-import httpx
 import yaml
+from pydantic import ValidationError
 
-from coingecko_ids import coingecko_ids
-from common import ChainId, Token
+import http_client
+import parse_executor
+from coingecko_ids import get_coingecko_ids, get_coingecko_ids_hash
+from common import Address, ChainId, Token
+from http_cache import CacheEntry, cache
+from json_stream import JSON_ERRORS, STREAM_PARSE_MIN_SIZE, streaming_available
+from metrics import current_report
+from provider_registry import Normalizer, ProviderSpec, load_provider_specs
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 with open("./logger.yml", "r") as stream:
@@ -17,472 +29,216 @@ logging.config.dictConfig(config)
 
 log = logging.getLogger(__name__)
 
+# provider name, one of its urls, the tokens parsed from it and a fingerprint of everything they were built from
+TokenBatch = tuple[str, str, list[Token], str]
+
 
 class TokenListProvider:
     name: str
     base_url: str
     chains: dict[str, str]
-    _by_chain_id = False
-    _get_chain_id_key = False
-    _tokens_to_list = False
-    absent_chain_id = False
+    spec: ProviderSpec
+    normalize: Normalizer
 
     @classmethod
     async def get_tokenlists(cls) -> dict[str, dict[ChainId, list[Token]]]:
         res: dict[ChainId, list[Token]] = defaultdict(list)
 
+        queue: asyncio.Queue[Optional[TokenBatch]] = asyncio.Queue()
+        await cls.stream_tokenlists(queue)
+        while not queue.empty():
+            if (batch := queue.get_nowait()) is not None:
+                for token in batch[2]:
+                    res[token.chainId].append(token)
+        return {cls.name: res}
+
+    @classmethod
+    async def stream_tokenlists(cls, queue: "asyncio.Queue[Optional[TokenBatch]]") -> None:
+        # every url gets a batch, even an empty one, so the consumer knows which urls are done; None is left
+        # for the consumer to mark the end of several providers' batches
+        async def put_url_tokens(url: str, chains: list[tuple[str, str]]) -> None:
+            tokens, fingerprint = await cls._get_url_tokens(url, chains)
+            await queue.put((cls.name, url, tokens, fingerprint))
+
+        await asyncio.gather(*[put_url_tokens(url, chains) for url, chains in cls.urls().items()])
+
+    @classmethod
+    def urls(cls) -> dict[str, list[tuple[str, str]]]:
+        # several chains often share one url (no "{}" in base_url), so download and decode each url once
+        chains_by_url: dict[str, list[tuple[str, str]]] = defaultdict(list)
         for chain_id, chain_name in cls.chains.items():
-            try:
-                resp = await httpx.AsyncClient().get(
-                    cls.base_url.format(chain_id if cls._by_chain_id else chain_name))
-            except httpx.ReadTimeout:
-                await asyncio.sleep(0.5)
-                continue
-            num_retries = 0
-            while resp.status_code != 200:
-                if num_retries > 60:
-                    raise Exception(f"failed to get tokenlits {cls.base_url} after {num_retries} retries")
-                sleep_time = int(resp.headers.get("Retry-After", 1))
-                num_retries += 1
-                log.info(f"[{cls.name}] {chain_id} {chain_name} waiting {sleep_time} seconds")
-                await asyncio.sleep(sleep_time)
-                resp = await httpx.AsyncClient().get(cls.base_url.format(chain_id if cls._by_chain_id else chain_name))
+            chains_by_url[cls._url(chain_id, chain_name)].append((chain_id, chain_name))
+        return chains_by_url
+
+    @classmethod
+    def cached_batch(
+        cls, url: str, chains: list[tuple[str, str]], coingecko_ids: dict[str, dict[Address, str]]
+    ) -> Optional[TokenBatch]:
+        # tokens of the last successful fetch of url, for when there is no time left to fetch it again
+        entry = cache.get(url)
+        if entry is None:
+            return None
+        try:
+            tokens, _ = cls._load_tokens(entry, chains)
+        except JSON_ERRORS as e:
+            log.error(f"[{cls.name}] cached {url} can't be decoded: {e!r}")
+            return None
+        cls._add_coingecko_ids(tokens, coingecko_ids)
+        return cls.name, url, tokens, f"{entry.content_hash}:{get_coingecko_ids_hash()}"
 
+    @classmethod
+    def _url(cls, chain_id: str, chain_name: str) -> str:
+        return cls.base_url.format(chain_id if cls.spec.by_chain_id else chain_name)
+
+    @classmethod
+    async def _get_url_tokens(cls, url: str, chains: list[tuple[str, str]]) -> tuple[list[Token], str]:
+        metrics = current_report().fetch(cls.name, url, [chain_id for chain_id, _ in chains])
+        entry = await http_client.fetch_entry(url, metrics=metrics)
+        if entry is None:
+            return [], ""
+
+        # decoding and validating large tokenlists is offloaded so it doesn't stall other downloads
+        started = time.perf_counter()
+        while True:
             try:
-                tokenlist = resp.json()
-            except:
-                tokenlist = json.loads(resp.text)
-            if "tokens" in tokenlist:
-                raw_tokens = tokenlist["tokens"]
-            elif "data" in tokenlist:
-                raw_tokens = tokenlist["data"]
-            elif "results" in tokenlist:
-                raw_tokens = tokenlist["results"]
-            elif "recommendedTokens" in tokenlist:
-                raw_tokens = tokenlist["recommendedTokens"]
-            else:
-                raw_tokens = tokenlist
+                tokens, metrics.parse_failures = await parse_executor.run(
+                    entry.size, _load_provider_tokens, cls.name, entry, chains
+                )
+                break
+            except JSON_ERRORS as e:
+                metrics.error = repr(e)
+                if entry.pending_path is None:
+                    # a damaged cache: it's dropped for the next run to download the url again rather than revalidate it
+                    log.error(f"[{cls.name}] cached {url} can't be decoded: {e!r}")
+                    cache.remove(url)
+                    return [], ""
+                # a new body that isn't json (a maintenance page, a truncated download) never replaces the cached one
+                cache.discard(entry)
+                entry = cache.get(url)
+                if entry is None:
+                    log.error(f"[{cls.name}] {url} can't be decoded: {e!r}")
+                    return [], ""
+                log.warning(
+                    f"[{cls.name}] {url} can't be decoded: {e!r}, using the response cached {entry.age / 3600:.1f}h ago"
+                )
+                metrics.stale = True
+        entry = cache.commit(entry)
+        metrics.decode_seconds = time.perf_counter() - started
+        metrics.tokens = len(tokens)
+
+        cls._add_coingecko_ids(tokens, await get_coingecko_ids())
+        for chain_id, chain_name in chains:
+            log.info(f"[{cls.name}] {chain_id} {chain_name} OK")
+        return tokens, f"{entry.content_hash}:{get_coingecko_ids_hash()}"
 
-            if cls._get_chain_id_key and str(chain_id) in raw_tokens:
-                raw_tokens = raw_tokens[str(chain_id)]
+    @staticmethod
+    def _add_coingecko_ids(tokens: list[Token], coingecko_ids: dict[str, dict[Address, str]]) -> None:
+        for token in tokens:
+            if not token.coingeckoId:
+                token.coingeckoId = coingecko_ids.get(str(token.chainId), {}).get(Address(token.address.lower()))
 
-            if cls._tokens_to_list:
-                raw_tokens = list(raw_tokens.values())
+    @classmethod
+    def _load_tokens(cls, entry: CacheEntry, chains: list[tuple[str, str]]) -> tuple[list[Token], int]:
+        # unchanged (304) tokenlists reuse the tokens parsed on a previous run with the same extractor
+        derived_name = f"parsed.{cls.name}.{cls.spec.fingerprint()[:16]}"
+        parsed = cache.get_derived(entry, derived_name)
+        if parsed is not None:
+            return [Token.construct(**t) for t in parsed["tokens"]], parsed["parse_failures"]
+
+        # large bodies are decoded token by token instead of into one giant object
+        stream = streaming_available() and entry.size >= STREAM_PARSE_MIN_SIZE
+        tokenlist = None if stream else json_loads(cache.read_body(entry))
+        extract = cls.spec.extract
+        tokens: list[Token] = []
+        parse_failures = 0
+        for i, (chain_id, chain_name) in enumerate(chains):
+            # tokens that carry their own chainId are the same for every chain of a shared url
+            if i == 0 or extract.per_chain:
+                chain_tokens, chain_failures = cls._parse_tokens(entry, tokenlist, chain_id)
+            elif extract.chain_id == "absent":
+                chain_tokens, chain_failures = cls._parse_tokens(entry, tokenlist, chain_id, only_absent_chain_id=True)
+            else:
+                continue
+            tokens += chain_tokens
+            parse_failures += chain_failures
+        # vars() is what BaseModel.dict() would return here, minus its per-field overhead
+        cache.put_derived(
+            entry, derived_name, {"tokens": [vars(t) for t in tokens], "parse_failures": parse_failures}
+        )
+        return tokens, parse_failures
 
-            tokens: list[Token] = []
-            for t in raw_tokens:
+    @classmethod
+    def _parse_tokens(
+        cls,
+        entry: CacheEntry,
+        tokenlist: Any,
+        chain_id: str,
+        only_absent_chain_id: bool = False,
+    ) -> tuple[list[Token], int]:
+        # tokenlist is the decoded body, or None to stream the tokens from the cached body
+        extract = cls.spec.extract
+        if tokenlist is None:
+            with cache.open_body(entry) as f:
+                return cls._normalize_tokens(extract.stream_tokens(f, chain_id), chain_id, only_absent_chain_id)
+        try:
+            raw_tokens = extract.tokens_at(tokenlist, chain_id)
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            log.error(f"[{cls.name}] response doesn't match extract.path {extract.path} for chain {chain_id}: {e!r}")
+            return [], 1
+        return cls._normalize_tokens(raw_tokens, chain_id, only_absent_chain_id)
 
-                if not isinstance(t, dict):
-                    log.error(f"Token must be of type dict, got {t=} {cls.__name__}")
+    @classmethod
+    def _normalize_tokens(
+        cls, raw_tokens: Iterable[Any], chain_id: str, only_absent_chain_id: bool
+    ) -> tuple[list[Token], int]:
+        extract = cls.spec.extract
+        normalize = cls.normalize
+        absent_chain_id = extract.chain_id == "absent"
+        tokens: list[Token] = []
+        parse_failures = 0
+        for t in raw_tokens:
+
+            if not isinstance(t, dict):
+                log.error(f"Token must be of type dict, got {t=} {cls.__name__}")
+                parse_failures += 1
+                continue
+            # a new dict with the token fields, the decoded tokenlist is shared between chains
+            t = normalize(t)
+            if not t.get("chainId"):
+                if absent_chain_id:
+                    t["chainId"] = int(chain_id)
+                else:
+                    log.error(f"{cls.name} chain id absent")
+                    parse_failures += 1
                     continue
-                if not t.get("chainId"):
-                    if cls.absent_chain_id:
-                        t["chainId"] = chain_id
-                    else:
-                        log.error(f"{cls.name} chain id absent")
-                        continue
-                if not t.get("coingeckoId"):
-                    t["coingeckoId"] = coingecko_ids.get(str(t["chainId"]), {}).get(t["address"].lower())
-                parsed_token = Token.parse_obj(t)
-                res[parsed_token.chainId].append(parsed_token)
-            log.info(f"[{cls.name}] {chain_id} {chain_name} OK")
-        return {cls.name: res}
+            elif only_absent_chain_id:
+                continue
+            try:
+                tokens.append(Token.from_raw(t))
+            except ValidationError as e:
+                log.error(f"[{cls.name}] invalid token {t.get('address')}: {e}")
+                parse_failures += 1
+        return tokens, parse_failures
+
+
+def provider_class(spec: ProviderSpec) -> type[TokenListProvider]:
+    # the extractor is compiled once per provider, not per response or token
+    return type(spec.name, (TokenListProvider,), {
+        "name": spec.name,
+        "base_url": spec.base_url,
+        "chains": spec.chains,
+        "spec": spec,
+        "normalize": staticmethod(spec.extract.compile()),
+    })
+
 
+tokenlists_providers = [provider_class(spec) for spec in load_provider_specs()]
 
-class CoinGeckoTokenLists(TokenListProvider):
-    name = "coingecko"
-    base_url = "https://tokens.coingecko.com/{}/all.json"
-    chains = {
-        "592": "astar",
-        "1284": "moonbeam",
-        "361": "theta",
-        "70": "hoo-smart-chain",
-        "42161": "arbitrum-one",
-        "56": "binance-smart-chain",
-        "66": "okex-chain",
-        "250": "fantom",
-        "88": "tomochain",
-        "82": "meter",
-        "42220": "celo",
-        "10": "optimistic-ethereum",
-        "137": "polygon-pos",
-        "43114": "avalanche",
-        "1285": "moonriver",
-        "25": "cronos",
-        "288": "boba",
-        "10000": "smartbch",
-        "1313161554": "aurora",
-        "1666600000": "harmony-shard-0",
-        "100": "xdai",
-        "1": "ethereum",
-        "-1": "solana",
-        "9001": "evmos",
-        # sora
-    }
-    absent_chain_id = True
-
-
-class UniswapTokenLists(TokenListProvider):
-    name = "uniswap"
-    base_url = "https://raw.githubusercontent.com/Uniswap/default-token-list/main/src/tokens/{}.json"
-    chains = {
-        "5": "goerli",
-        "42": "kovan",
-        "1": "mainnet",
-        "80001": "mumbai",
-        "137": "polygon",
-        "4": "rinkeby",
-        "3": "ropsten",
-    }
-
-
-class SushiswapTokenLists(TokenListProvider):
-    name = "sushiswap"
-    base_url = "https://raw.githubusercontent.com/sushiswap/default-token-list/master/tokens/{}.json"
-    chains = {
-        "42161": "arbitrum",
-        "43114": "avalanche",
-        "97": "bsc-testnet",
-        "56": "bsc",
-        "42220": "celo",
-        "1024": "clover",
-        "4002": "fantom-testnet",
-        "250": "fantom",
-        "43113": "fuji",
-        "122": "fuse",
-        "5": "goerli",
-        "1666700000": "harmony-testnet",
-        "1666600000": "harmony",
-        "256": "heco-testnet",
-        "128": "heco",
-        "42": "kovan",
-        "1": "mainnet",
-        "80001": "matic-testnet",
-        "137": "matic",
-        "1287": "moonbase",
-        "1285": "moonriver",
-        "1284": "moonbeam",
-        "65": "okex-testnet",
-        "66": "okex",
-        "11297108109": "palm",
-        "4": "rinkeby",
-        "3": "ropsten",
-        "40": "telos",
-        "100": "xdai"
-    }
-
-
-class OneInchTokenLists(TokenListProvider):
-    name = "1inch"
-    base_url = "https://api.1inch.io/v4.0/{}/tokens"
-    chains = {
-        "1": "1",
-        "56": "56",
-        "137": "137",
-        "10": "10",
-        "42161": "42161",
-        "100": "100",
-        "43114": "43114",
-        "250": "250",
-        "1313161554": "1313161554",
-    }
-    _tokens_to_list = True
-    absent_chain_id = True
-
-
-class OpenOceanTokenLists(TokenListProvider):
-    # TODO: maybe more, check all ids from coingecko
-    name = "openocean"
-    base_url = "https://open-api.openocean.finance/v1/cross/tokenList?chainId={}"
-    chains = {
-        "42161": "arbitrum-one",
-        "43114": "avalanche",
-        "56": "binance-smart-chain",
-        "66": "okex-chain",
-        "250": "fantom",
-        "10": "optimistic-ethereum",
-        "137": "polygon-pos",
-        "288": "boba",
-        "100": "xdai-gnosis",
-        "128": "heco",
-        "1": "ethereum",
-    }
-    _by_chain_id = True
-    absent_chain_id = True
-
-
-class ElkFinanceTokenLists(TokenListProvider):
-    name = "elkfinance"
-    base_url = "https://raw.githubusercontent.com/elkfinance/tokens/main/{}.tokenlist.json"
-    chains = {
-        "42161": "farms",
-        "43114": "avax",
-        "56": "bsc",
-        "25": "cronos",
-        "20": "elastos",
-        "1": "ethereum",
-        "250": "ftm",
-        "4002": "ftmtest",
-        "43113": "fuji",
-        "122": "fuse",
-        "1666600000": "harmony",
-        "128": "heco",
-        "70": "hoo",
-        "4689": "iotex",
-        "321": "kcc",
-        "137": "matic",
-        "1285": "moonriver",
-        "80001": "mumbai",
-        "66": "okex",
-        "40": "telos",
-        "100": "xdai"
-    }
-    # "all", "top"
-
-
-class RefFinanceTokenLists(TokenListProvider):
-    # unusual format
-    base_url = "https://indexer.ref-finance.net/list-token"
-
-
-class OneSolTokenLists(TokenListProvider):
-    name = "1sol"
-    base_url = "https://api.1sol.io/2/101/token-list"
-    chains = {
-        "-1": "solana"
-    }
-
-
-class QuickSwapTokenLists(TokenListProvider):
-    name = "quickswap"
-    base_url = "https://raw.githubusercontent.com/sameepsi/quickswap-default-token-list/master/src/tokens/mainnet.json"
-    chains = {
-        "137": "polygon"
-    }
-
-
-class FuseSwapTokenLists(TokenListProvider):
-    name = "fuseswap"
-    base_url = "https://raw.githubusercontent.com/fuseio/fuseswap-default-token-list/master/src/tokens/fuse.json"
-    chains = {
-        "122": "fuse"
-    }
-
-
-class TrisolarisLabsLists(TokenListProvider):
-    name = "trisolaris"
-    base_url = "https://raw.githubusercontent.com/trisolaris-labs/tokens/master/lists/{}/list.json"
-    chains = {
-        "1313161554": "1313161554",
-    }
-
-
-class RubicLists(TokenListProvider):
-    name = "rubic"
-    base_url = "https://api.rubic.exchange/api/tokens/?network={}"
-    chains = {
-        "-2": "near",
-        "-1": "solana",
-        "1": "ethereum",
-        # "25": "cronos",
-        "40": "telos",
-        "56": "binance-smart-chain",
-        "100": "xdai",
-        "137": "polygon",
-        "250": "fantom",
-        "1284": "moonbeam",
-        "1285": "moonriver",
-        "42161": "arbitrum",
-        "43114": "avalanche",
-        "1313161554": "aurora",
-        "1666600000": "harmony",
-    }
-    absent_chain_id = True
-
-
-class CronaSwapLists(TokenListProvider):
-    name = "cronaswap"
-    base_url = "https://raw.githubusercontent.com/cronaswap/default-token-list/main/assets/tokens/cronos.json"
-    chains = {"25": "cronos"}
-
-
-class Ubeswap(TokenListProvider):
-    name = "ubeswap"
-    base_url = "https://raw.githubusercontent.com/Ubeswap/default-token-list/master/ubeswap.token-list.json"
-    chains = {"42220": "celo"}
-
-
-class OolongSwap(TokenListProvider):
-    name = "oolongswap"
-    base_url = "https://raw.githubusercontent.com/OolongSwap/boba-community-token-list/main/src/tokens/boba.json"
-    chains = {"288": "boba"}
-
-
-class Multichain(TokenListProvider):
-    name = "multichain"
-    base_url = "https://bridgeapi.anyswap.exchange/v4/poollist/{}"
-    chains = {"592": "592"}
-    _tokens_to_list = True
-
-
-class XyFinance(TokenListProvider):
-    name = "xyfinance"
-    base_url = "https://open-api.xy.finance/v1/recommendedTokens?chainId={}"
-    chains = {
-        "1": "1",
-        "56": "56",
-        "137": "137",
-        "250": "250",
-        "25": "25",
-        "43114": "43114",
-        "42161": "42161",
-        "10": "10",
-        "1285": "1285",
-        "592": "592",
-        "321": "321",
-        "1818": "1818",
-    }
+_providers_by_name = {provider.name: provider for provider in tokenlists_providers}
 
 
-class MojitoSwap(TokenListProvider):
-    name = "mojitoswap"
-    base_url = "https://raw.githubusercontent.com/MojitoFinance/mjtTokenList/461d2ca814d12c37516b986fabfcd21446283ed7/mjtTokenList.json"
-    chains = {"321": "321"}
-    absent_chain_id = True
-
-
-class CapricornFinance(TokenListProvider):
-    name = "capricorn_finance"
-    base_url = "https://raw.githubusercontent.com/capricorn-finance/info-blist/main/list.json"
-    chains = {"1818": "1818"}
-
-
-class Lifinance(TokenListProvider):
-    name = "lifinance"
-    base_url = "https://li.quest/v1/tokens?chains={}"
-    _get_chain_id_key = True
-
-    chains = {
-        "1": "1",
-        "10": "10",
-        "25": "25",
-        "56": "56",
-        "66": "66",
-        "100": "100",
-        "122": "122",
-        "137": "137",
-        "250": "250",
-        "1284": "1284",
-        "1285": "1285",
-        "9001": "9001",
-        "42161": "42161",
-        "42220": "42220",
-        "43114": "43114",
-        "1666600000": "1666600000",
-    }
-
-
-class Dfyn(TokenListProvider):
-    name = "dfyn"
-    base_url = "https://raw.githubusercontent.com/dfyn/new-host/main/list-token.tokenlist.json"
-
-    chains = {
-        "1": "1",
-        "10": "10",
-        "25": "25",
-        "56": "56",
-        "137": "137",
-        "250": "250",
-        "43114": "43114",
-        "1666600000": "1666600000",
-    }
-
-
-class PancakeSwap(TokenListProvider):
-    name = "pancake"
-    base_url = "https://tokens.pancakeswap.finance/pancakeswap-extended.json"
-
-    chains = {"56": "56"}
-
-
-class Pangolin(TokenListProvider):
-    name = "pangolin"
-    base_url = "https://raw.githubusercontent.com/pangolindex/tokenlists/main/pangolin.tokenlist.json"
-
-    chains = {"43114": "43114"}
-
-
-class TraderJoe(TokenListProvider):
-    name = "joe"
-    base_url = "https://raw.githubusercontent.com/traderjoe-xyz/joe-tokenlists/main/joe.tokenlist.json"
-
-    chains = {"43114": "43114"}
-
-
-class ArbitrumBridge(TokenListProvider):
-    name = "arbitrum_bridge"
-    base_url = "https://bridge.arbitrum.io/token-list-42161.json"
-
-    chains = {"42161": "42161", "1": "1"}
-
-
-class Optimism(TokenListProvider):
-    name = "optimism"
-    base_url = "https://static.optimism.io/optimism.tokenlist.json"
-
-    chains = {"1": "1", "10": "10", }
-
-
-class SpookySwap(TokenListProvider):
-    name = "SpookySwap"
-    base_url = "https://raw.githubusercontent.com/SpookySwap/spooky-info/master/src/constants/token/spookyswap.json"
-
-    chains = {"250": "250"}
-
-
-class RouterProtocol(TokenListProvider):
-    name = "RouterProtocol"
-    base_url = "https://raw.githubusercontent.com/router-protocol/reserve-asset-list/main/router-reserve-asset.json"
-
-    chains = {
-        "1": "1",
-        "10": "10",
-        "25": "25",
-        "56": "56",
-        "137": "137",
-        "250": "250",
-        "42161": "42161",
-        "1313161554": "1313161554",
-        "1666600000": "1666600000",
-    }
-
-
-tokenlists_providers = [
-    CoinGeckoTokenLists,
-    OneInchTokenLists,
-    UniswapTokenLists,
-    SushiswapTokenLists,
-    OpenOceanTokenLists,
-    OneSolTokenLists,
-    QuickSwapTokenLists,
-    FuseSwapTokenLists,
-    TrisolarisLabsLists,
-    Dfyn,
-    RouterProtocol,
-    SpookySwap,
-    Optimism,
-    ArbitrumBridge,
-    TraderJoe,
-    Pangolin,
-    PancakeSwap,
-    MojitoSwap,
-    RubicLists,
-    Lifinance,
-    XyFinance,
-    ElkFinanceTokenLists,
-    Multichain,
-    CronaSwapLists,
-    Ubeswap,
-    OolongSwap,
-    CapricornFinance,
-]
+def _load_provider_tokens(
+    provider_name: str, entry: CacheEntry, chains: list[tuple[str, str]]
+) -> tuple[list[Token], int]:
+    # provider classes are built at import, a worker process finds them by name rather than unpickling them
+    return _providers_by_name[provider_name]._load_tokens(entry, chains)
@@ -0,0 +1,89 @@
+import os
+from collections import defaultdict
+from typing import Optional, Union
+
+from common import ALL_TOKENS_FOLDER, CHAIN_NAMES_BY_ID, TOKENLISTS_FOLDER, TokenRecord
+from tokenlist_loader import load_all, load_chain
+
+CHAIN_IDS_BY_NAME = {name: int(chain_id) for chain_id, name in CHAIN_NAMES_BY_ID.items()}
+
+Chain = Union[int, str]
+
+
+def resolve_chain_id(chain: Chain) -> int:
+    # 56, "56" and "bsc" all resolve to 56
+    if isinstance(chain, int):
+        return chain
+    if chain.lstrip("-").isdigit():
+        return int(chain)
+    if chain.lower() not in CHAIN_IDS_BY_NAME:
+        raise KeyError(f"unknown chain {chain}")
+    return CHAIN_IDS_BY_NAME[chain.lower()]
+
+
+def chain_name(chain: Chain) -> str:
+    chain_id = resolve_chain_id(chain)
+    return CHAIN_NAMES_BY_ID.get(str(chain_id), str(chain_id))
+
+
+class TokenRegistry:
+    # chains are loaded from their own files on first use, so a process that only needs
+    # one chain never parses the others; coingecko lookups need every chain and load all.msgpack
+    def __init__(self, folder: str = TOKENLISTS_FOLDER):
+        self.folder = folder
+        self._tokens: dict[int, list[TokenRecord]] = {}
+        self._by_address: dict[tuple[int, str], TokenRecord] = {}
+        self._by_symbol: dict[tuple[int, str], list[TokenRecord]] = defaultdict(list)
+        self._by_coingecko_id: dict[str, list[TokenRecord]] = defaultdict(list)
+        self._all_loaded = False
+
+    @classmethod
+    def all_tokens(cls) -> "TokenRegistry":
+        return cls(ALL_TOKENS_FOLDER)
+
+    def _index(self, chain_id: int, tokens: list[TokenRecord]) -> None:
+        self._tokens[chain_id] = tokens
+        for t in tokens:
+            self._by_address[(chain_id, t.address.lower())] = t
+            self._by_symbol[(chain_id, t.symbol.lower())].append(t)
+            if t.coingeckoId:
+                self._by_coingecko_id[t.coingeckoId].append(t)
+
+    def load_chain(self, chain: Chain) -> list[TokenRecord]:
+        chain_id = resolve_chain_id(chain)
+        if chain_id not in self._tokens:
+            path = os.path.join(self.folder, f"{chain_name(chain_id)}.json")
+            self._index(chain_id, load_chain(path) if os.path.exists(path) else [])
+        return self._tokens[chain_id]
+
+    def load_all(self) -> None:
+        if self._all_loaded:
+            return
+        path = os.path.join(self.folder, "all.msgpack")
+        if not os.path.exists(path):
+            path = os.path.join(self.folder, "all.json")
+        for chain_id, tokens in load_all(path).items():
+            if chain_id not in self._tokens:
+                self._index(chain_id, tokens)
+        self._all_loaded = True
+
+    def chains(self) -> list[int]:
+        self.load_all()
+        return sorted(chain_id for chain_id, tokens in self._tokens.items() if tokens)
+
+    def tokens(self, chain: Chain) -> list[TokenRecord]:
+        return self.load_chain(chain)
+
+    def get(self, chain: Chain, address: str) -> Optional[TokenRecord]:
+        chain_id = resolve_chain_id(chain)
+        self.load_chain(chain_id)
+        return self._by_address.get((chain_id, address.lower()))
+
+    def by_symbol(self, chain: Chain, symbol: str) -> list[TokenRecord]:
+        chain_id = resolve_chain_id(chain)
+        self.load_chain(chain_id)
+        return self._by_symbol.get((chain_id, symbol.lower()), [])
+
+    def by_coingecko_id(self, coingecko_id: str) -> list[TokenRecord]:
+        self.load_all()
+        return self._by_coingecko_id.get(coingecko_id, [])
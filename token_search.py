@@ -0,0 +1,144 @@
+import heapq
+import re
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from typing import NamedTuple, Optional
+
+import msgpack  # type: ignore[import]
+
+from common import TokenRecord
+
+SEARCH_INDEX_VERSION = 1
+
+# only the best ranked tokens of a chain (or of all chains) are kept per trigram, common trigrams like "tok" say
+# little about a match anyway
+MAX_TRIGRAM_POSTINGS = 500
+
+# share of the query's trigrams a fuzzy match needs
+MIN_TRIGRAM_SIMILARITY = 0.5
+
+# prefix results scanning more entries than this are kept, they come from short queries like "t" typed on every search
+PREFIX_MEMO_MIN_ENTRIES = 2000
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+class SearchHit(NamedTuple):
+    chain_id: int
+    address: str
+    symbol: str
+    name: str
+    listed: int
+
+
+def _keys(symbol: str, name: str) -> set[str]:
+    # "Wrapped Ether" is found by "wrapped ether", "wrapped" and "ether"
+    symbol, name = symbol.lower(), name.lower()
+    return {symbol, name, *_WORD_RE.findall(name)} - {""}
+
+
+def _trigrams(text: str) -> set[str]:
+    text = f" {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    # tokens are numbered by rank (most listed first), so the best matches of a key range are its smallest refs;
+    # prefix lookups are two bisects over keys sorted once at aggregation time
+    def __init__(self, hits: list[SearchHit], keys: list[str], refs: list[int]):
+        self.hits = hits
+        self.keys = keys
+        self.refs = refs
+        self._chain_keys: dict[int, tuple[list[str], list[int]]] = {}
+        self._trigrams: dict[Optional[int], dict[str, list[int]]] = {}
+        self._prefix_memo: dict[tuple[str, Optional[int], int], list[int]] = {}
+
+    @classmethod
+    def build(cls, tokens_by_chain: dict[int, list[TokenRecord]]) -> "SearchIndex":
+        hits = [
+            SearchHit(chain_id, t.address, t.symbol, t.name, len(t.listedIn))
+            for chain_id, tokens in tokens_by_chain.items() for t in tokens
+        ]
+        hits.sort(key=lambda h: (-h.listed, len(h.symbol), h.symbol.lower(), h.chain_id, h.address))
+        entries = sorted((key, ref) for ref, hit in enumerate(hits) for key in _keys(hit.symbol, hit.name))
+        return cls(hits, [key for key, _ in entries], [ref for _, ref in entries])
+
+    def to_bytes(self) -> bytes:
+        return msgpack.packb({
+            "version": SEARCH_INDEX_VERSION,
+            "hits": [list(hit) for hit in self.hits],
+            "keys": self.keys,
+            "refs": self.refs,
+        })
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "SearchIndex":
+        unpacked = msgpack.unpackb(data)
+        if unpacked["version"] != SEARCH_INDEX_VERSION:
+            raise ValueError(f"unsupported search index version {unpacked['version']}")
+        return cls([SearchHit(*hit) for hit in unpacked["hits"]], unpacked["keys"], unpacked["refs"])
+
+    @classmethod
+    def load(cls, path: str) -> "SearchIndex":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    def _chain_index(self, chain_id: Optional[int]) -> tuple[list[str], list[int]]:
+        # a chain's entries are the global ones filtered, which keeps them sorted
+        if chain_id is None:
+            return self.keys, self.refs
+        if chain_id not in self._chain_keys:
+            entries = [(k, r) for k, r in zip(self.keys, self.refs) if self.hits[r].chain_id == chain_id]
+            self._chain_keys[chain_id] = [k for k, _ in entries], [r for _, r in entries]
+        return self._chain_keys[chain_id]
+
+    def _trigram_index(self, chain_id: Optional[int]) -> dict[str, list[int]]:
+        # built per chain, a global list capped before filtering would leave a small chain's tokens out
+        if chain_id not in self._trigrams:
+            postings: dict[str, list[int]] = {}
+            for ref, hit in enumerate(self.hits):
+                if chain_id is not None and hit.chain_id != chain_id:
+                    continue
+                for trigram in _trigrams(f"{hit.symbol} {hit.name}".lower()):
+                    refs = postings.setdefault(trigram, [])
+                    if len(refs) < MAX_TRIGRAM_POSTINGS:
+                        refs.append(ref)
+            self._trigrams[chain_id] = postings
+        return self._trigrams[chain_id]
+
+    def prefix(self, query: str, chain_id: Optional[int] = None, limit: int = 20) -> list[SearchHit]:
+        query = query.lower().strip()
+        if not query:
+            return []
+        memo_key = (query, chain_id, limit)
+        if memo_key in self._prefix_memo:
+            return [self.hits[r] for r in self._prefix_memo[memo_key]]
+        keys, refs = self._chain_index(chain_id)
+        lo = bisect_left(keys, query)
+        exact_hi = bisect_right(keys, query, lo)
+        hi = bisect_left(keys, query + "\uffff", exact_hi)
+        # exact matches first, then the other prefix matches, each by rank; refs of one key are sorted already.
+        # A token has a few keys, so more refs than needed are taken before dropping duplicates
+        res = refs[lo:min(exact_hi, lo + limit)]
+        if len(res) < limit:
+            res += [r for r in dict.fromkeys(heapq.nsmallest(limit * 4, refs[exact_hi:hi])) if r not in res]
+        res = res[:limit]
+        if hi - lo > PREFIX_MEMO_MIN_ENTRIES:
+            self._prefix_memo[memo_key] = res
+        return [self.hits[r] for r in res]
+
+    def fuzzy(self, query: str, chain_id: Optional[int] = None, limit: int = 20) -> list[SearchHit]:
+        query_trigrams = _trigrams(query.lower().strip())
+        postings = self._trigram_index(chain_id)
+        counts = Counter(r for t in query_trigrams for r in postings.get(t, ()))
+        min_shared = len(query_trigrams) * MIN_TRIGRAM_SIMILARITY
+        matches = [(-shared, r) for r, shared in counts.items() if shared >= min_shared]
+        return [self.hits[r] for _, r in heapq.nsmallest(limit, matches)]
+
+    def search(self, query: str, chain_id: Optional[int] = None, limit: int = 20) -> list[SearchHit]:
+        # prefix matches, topped up with fuzzy ones for misspelled or partial queries
+        res = self.prefix(query, chain_id, limit)
+        if len(res) < limit:
+            found = set(res)
+            res += [hit for hit in self.fuzzy(query, chain_id, limit) if hit not in found][:limit - len(res)]
+        return res
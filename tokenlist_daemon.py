@@ -0,0 +1,315 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from itertools import compress
+from typing import Any, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import http_client
+import parse_executor
+from aggregate_state import SNAPSHOT_PATH
+from aggregate_tokens import TokenMerger, _split_by_chain
+from common import CHAIN_NAMES_BY_ID, Token, TokenRecord
+from metrics import start_run
+from output_writer import chain_file, encode_tokens
+from token_list_providers import TokenBatch, TokenListProvider, tokenlists_providers
+from token_registry import resolve_chain_id
+from token_search import SearchIndex
+from tokenlist_loader import load_all
+from trust_policy import TrustPolicy
+
+DAEMON_HOST = os.environ.get("TOKENLISTS_DAEMON_HOST", "127.0.0.1")
+
+DAEMON_PORT = int(os.environ.get("TOKENLISTS_DAEMON_PORT", 8080))
+
+DEFAULT_REFRESH_INTERVAL = 30 * 60
+
+# providers refreshed on another schedule than DEFAULT_REFRESH_INTERVAL, in seconds
+REFRESH_INTERVALS: dict[str, float] = {
+    # one request per chain against a rate limited api
+    "coingecko": 2 * 60 * 60,
+    "lifinance": 10 * 60,
+}
+
+MAX_REQUEST_HEAD_SIZE = 16 * 1024
+
+# responses smaller than this aren't worth compressing
+GZIP_MIN_SIZE = 1024
+
+SEARCH_LIMIT = 20
+
+log = logging.getLogger(__name__)
+
+
+class Response:
+    __slots__ = ("status", "body", "content_type", "etag", "_gzipped")
+
+    def __init__(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self._gzipped: Optional[bytes] = None
+
+    @classmethod
+    def json(cls, data: Any, status: int = 200) -> "Response":
+        return cls(status, json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode())
+
+    def gzipped(self) -> bytes:
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6, mtime=0)
+        return self._gzipped
+
+
+_REASONS = {
+    200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+class TokenState:
+    # merged tokens kept in memory; a provider refresh re-merges only the chains its batches changed
+    def __init__(self, providers: list[type[TokenListProvider]], policy: TrustPolicy):
+        self.providers = providers
+        self.policy = policy
+        # (provider name, url) -> fingerprint and tokens by chain of its last successful batch
+        self.batches: dict[tuple[str, str], tuple[str, dict[int, list[Token]]]] = {}
+        self.tokens: dict[int, list[TokenRecord]] = {}
+        self.tiers: dict[int, dict[str, list[bool]]] = {}
+        self.by_address: dict[int, dict[str, TokenRecord]] = {}
+        self.chain_versions: dict[int, int] = defaultdict(int)
+        self._chain_responses: dict[tuple[int, str], tuple[int, Response]] = {}
+        # bumped on every change of any chain
+        self.version = 0
+        self._search_indexes: dict[str, tuple[int, SearchIndex]] = {}
+        self.updated_at = 0.0
+
+    def load_snapshot(self) -> None:
+        # served until the first refresh of every provider has finished
+        if os.path.exists(SNAPSHOT_PATH):
+            self._set_chains(load_all(SNAPSHOT_PATH))
+            log.info(f"serving {sum(len(v) for v in self.tokens.values())} tokens from the last snapshot")
+
+    def add_batch(self, batch: TokenBatch) -> set[int]:
+        provider_name, url, tokens, fingerprint = batch
+        if not fingerprint:
+            # the fetch failed without a cached response, keep serving what it had before
+            return set()
+        previous = self.batches.get((provider_name, url))
+        if previous is not None and previous[0] == fingerprint:
+            return set()
+        tokens_by_chain = _split_by_chain(tokens)
+        self.batches[(provider_name, url)] = (fingerprint, tokens_by_chain)
+        return set(tokens_by_chain) | (set(previous[1]) if previous is not None else set())
+
+    def merge(self, chains: set[int]) -> None:
+        if not chains:
+            return
+        merger = TokenMerger(self.providers, self.policy)
+        for (provider_name, _), (_, tokens_by_chain) in self.batches.items():
+            for chain_id, tokens in tokens_by_chain.items():
+                if chain_id in chains:
+                    merger.add(provider_name, tokens)
+        merged = merger.merged()
+        self._set_chains({chain_id: merged.get(chain_id, []) for chain_id in chains})
+        log.info(f"re-merged {len(chains)} chains")
+
+    def _set_chains(self, tokens_by_chain: dict[int, list[TokenRecord]]) -> None:
+        for chain_id, tokens in tokens_by_chain.items():
+            if tokens:
+                self.tokens[chain_id] = tokens
+                self.tiers[chain_id] = self.policy.tiers_of(chain_id, tokens)
+                self.by_address[chain_id] = {t.address.lower(): t for t in tokens}
+            else:
+                self.tokens.pop(chain_id, None)
+                self.tiers.pop(chain_id, None)
+                self.by_address.pop(chain_id, None)
+            self.chain_versions[chain_id] += 1
+        self.tokens = dict(sorted(self.tokens.items()))
+        self.version += 1
+        self.updated_at = time.time()
+
+    def tier_tokens(self, chain_id: int, tier: str) -> list[TokenRecord]:
+        return list(compress(self.tokens.get(chain_id, []), self.tiers.get(chain_id, {}).get(tier, [])))
+
+    def chain_response(self, chain_id: int, tier: str) -> Response:
+        # encoded once per chain version and tier, then served as is
+        version = self.chain_versions[chain_id]
+        cached = self._chain_responses.get((chain_id, tier))
+        if cached is None or cached[0] != version:
+            body = chain_file(encode_tokens(self.tier_tokens(chain_id, tier), minified=True), minified=True)
+            cached = self._chain_responses[(chain_id, tier)] = version, Response(200, body)
+        return cached[1]
+
+    def search_index(self, tier: str) -> SearchIndex:
+        # rebuilt by the first search after a refresh changed anything
+        cached = self._search_indexes.get(tier)
+        if cached is None or cached[0] != self.version:
+            index = SearchIndex.build({chain_id: self.tier_tokens(chain_id, tier) for chain_id in self.tokens})
+            cached = self._search_indexes[tier] = self.version, index
+        return cached[1]
+
+    def search(self, query: str, chain_id: Optional[int], tier: str, limit: int) -> list[TokenRecord]:
+        hits = self.search_index(tier).search(query, chain_id, limit)
+        return [self.by_address[hit.chain_id][hit.address.lower()] for hit in hits]
+
+
+class TokenlistDaemon:
+    def __init__(self, providers: list[type[TokenListProvider]] = tokenlists_providers):
+        self.providers = providers
+        self.policy = TrustPolicy.load()
+        self.state = TokenState(providers, self.policy)
+
+    async def _fetch(self, provider: type[TokenListProvider]) -> set[int]:
+        # each refresh gets its own run report, a long running process would otherwise grow one forever
+        start_run()
+        queue: asyncio.Queue[Optional[TokenBatch]] = asyncio.Queue()
+        await provider.stream_tokenlists(queue)
+        changed: set[int] = set()
+        while not queue.empty():
+            if (batch := queue.get_nowait()) is not None:
+                changed |= self.state.add_batch(batch)
+        return changed
+
+    async def refresh(self, provider: type[TokenListProvider]) -> None:
+        started = time.perf_counter()
+        self.state.merge(await self._fetch(provider))
+        log.info(f"[{provider.name}] refreshed in {time.perf_counter() - started:.1f}s")
+
+    async def _refresh_forever(self, provider: type[TokenListProvider]) -> None:
+        interval = REFRESH_INTERVALS.get(provider.name, DEFAULT_REFRESH_INTERVAL)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh(provider)
+            except Exception:
+                log.exception(f"[{provider.name}] refresh failed")
+
+    async def _initial_load(self) -> None:
+        results = await asyncio.gather(*[self._fetch(provider) for provider in self.providers], return_exceptions=True)
+        for provider, result in zip(self.providers, results):
+            if isinstance(result, BaseException):
+                log.error(f"[{provider.name}] initial load failed: {result!r}")
+        # chains of the snapshot that no provider lists anymore are dropped as well
+        chains = set(self.state.tokens)
+        for _, tokens_by_chain in self.state.batches.values():
+            chains |= tokens_by_chain.keys()
+        self.state.merge(chains)
+
+    def route(self, method: str, target: str) -> Response:
+        if method not in ("GET", "HEAD"):
+            return Response.json({"error": "method not allowed"}, 405)
+        url = urlsplit(target)
+        parts = [unquote(p) for p in url.path.strip("/").split("/") if p]
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        tier = query.get("tier", self.policy.default_tier)
+        if tier not in self.policy.tiers:
+            return Response.json({"error": f"unknown tier {tier}"}, 400)
+        try:
+            if parts == ["health"]:
+                return Response.json({"chains": len(self.state.tokens), "updatedAt": self.state.updated_at})
+            if parts == ["chains"]:
+                return Response.json({
+                    str(chain_id): {
+                        "name": CHAIN_NAMES_BY_ID.get(str(chain_id), str(chain_id)),
+                        "tokens": sum(self.state.tiers[chain_id][tier]),
+                    }
+                    for chain_id in self.state.tokens
+                })
+            if len(parts) == 2 and parts[0] == "tokens":
+                return self.state.chain_response(resolve_chain_id(parts[1]), tier)
+            if len(parts) == 3 and parts[0] == "tokens":
+                token = self.state.by_address.get(resolve_chain_id(parts[1]), {}).get(parts[2].lower())
+                if token is None:
+                    return Response.json({"error": "token not found"}, 404)
+                return Response.json(token.dict())
+            if parts == ["search"]:
+                chain_id = resolve_chain_id(query["chain"]) if "chain" in query else None
+                limit = min(int(query.get("limit", SEARCH_LIMIT)), 100)
+                if limit < 1:
+                    raise ValueError(f"limit must be positive, got {limit}")
+                tokens = self.state.search(query.get("q", ""), chain_id, tier, limit)
+                return Response.json([t.dict() for t in tokens])
+        except KeyError as e:
+            return Response.json({"error": e.args[0]}, 400)
+        except ValueError as e:
+            return Response.json({"error": str(e)}, 400)
+        return Response.json({"error": "not found"}, 404)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = request_line.split(" ")
+                except ValueError:
+                    return
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                try:
+                    response = self.route(method, target)
+                except Exception:
+                    log.exception(f"{method} {target} failed")
+                    response = Response.json({"error": "internal error"}, 500)
+                # request bodies are never read, the connection is closed rather than taking one for the next request
+                has_body = "transfer-encoding" in headers or headers.get("content-length", "0").strip() != "0"
+                keep_alive = (
+                    version == "HTTP/1.1" and headers.get("connection", "").lower() != "close" and not has_body
+                )
+                writer.write(self._encode(method, response, headers, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _encode(method: str, response: Response, request_headers: dict[str, str], keep_alive: bool) -> bytes:
+        status = response.status
+        body = response.body
+        headers = {
+            "Content-Type": response.content_type,
+            "ETag": response.etag,
+            "Vary": "Accept-Encoding",
+            "Connection": "keep-alive" if keep_alive else "close",
+        }
+        if status == 200 and response.etag in request_headers.get("if-none-match", ""):
+            status, body = 304, b""
+        elif len(body) >= GZIP_MIN_SIZE and "gzip" in request_headers.get("accept-encoding", ""):
+            body = response.gzipped()
+            headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = str(len(body))
+        head = f"HTTP/1.1 {status} {_REASONS[status]}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        return head.encode("latin-1") + b"\r\n" + (body if method != "HEAD" else b"")
+
+    async def serve(self, host: str = DAEMON_HOST, port: int = DAEMON_PORT) -> None:
+        self.state.load_snapshot()
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_REQUEST_HEAD_SIZE)
+        log.info(f"serving tokenlists on http://{host}:{port}")
+        tasks = [asyncio.ensure_future(self._initial_load())]
+        tasks += [asyncio.ensure_future(self._refresh_forever(provider)) for provider in self.providers]
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await http_client.close_client()
+            parse_executor.shutdown_executor()
+
+
+if __name__ == "__main__":
+    asyncio.run(TokenlistDaemon().serve())
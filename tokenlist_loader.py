@@ -0,0 +1,109 @@
+import gzip
+import json
+from typing import Any, Optional
+
+import brotli  # type: ignore[import]
+import msgpack  # type: ignore[import]
+
+from common import Address, ChainId, TokenRecord
+
+MSGPACK_VERSION = 1
+
+# every token is packed as a fixed-size array in this order, chainId is the key it is stored under
+MSGPACK_FIELDS = ("symbol", "name", "address", "decimals", "logoURI", "coingeckoId", "listedIn")
+
+
+class _StringTable:
+    def __init__(self):
+        self.strings: list[str] = []
+        self.index: dict[str, int] = {}
+
+    def add(self, s: Optional[str]) -> Optional[int]:
+        if s is None:
+            return None
+        if s not in self.index:
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return self.index[s]
+
+
+def pack_tokens(tokens_by_chain: dict[int, list[TokenRecord]]) -> bytes:
+    table = _StringTable()
+    chains = {}
+    for chain_id, tokens in tokens_by_chain.items():
+        packed = []
+        for t in tokens:
+            logo = None
+            if t.logoURI is not None:
+                # logos mostly differ only past the host/folder, which goes to the string table
+                prefix, _, rest = t.logoURI.rpartition("/")
+                logo = [table.add(prefix), rest] if prefix else [None, t.logoURI]
+            packed.append([
+                table.add(t.symbol),
+                table.add(t.name),
+                t.address,
+                t.decimals,
+                logo,
+                table.add(t.coingeckoId),
+                [table.add(p) for p in t.listedIn],
+            ])
+        chains[chain_id] = packed
+    return msgpack.packb(
+        {"version": MSGPACK_VERSION, "fields": list(MSGPACK_FIELDS), "strings": table.strings, "chains": chains}
+    )
+
+
+def _unpack_logo(strings: list[str], logo: Optional[list]) -> Optional[str]:
+    if logo is None:
+        return None
+    prefix, rest = logo
+    return f"{strings[prefix]}/{rest}" if prefix is not None else rest
+
+
+def unpack_tokens(data: bytes) -> dict[int, list[TokenRecord]]:
+    unpacked = msgpack.unpackb(data, strict_map_key=False)
+    if unpacked["version"] != MSGPACK_VERSION:
+        raise ValueError(f"unsupported tokenlist msgpack version {unpacked['version']}")
+    strings = unpacked["strings"]
+    res: dict[int, list[TokenRecord]] = {}
+    for chain_id, packed in unpacked["chains"].items():
+        res[chain_id] = [
+            TokenRecord(
+                symbol=strings[symbol],
+                name=strings[name],
+                address=Address(address),
+                decimals=decimals,
+                chainId=ChainId(chain_id),
+                logoURI=_unpack_logo(strings, logo),
+                coingeckoId=strings[coingecko_id] if coingecko_id is not None else None,
+                listedIn=[strings[p] for p in listed_in],
+            )
+            for symbol, name, address, decimals, logo, coingecko_id, listed_in in packed
+        ]
+    return res
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".gz"):
+        return gzip.decompress(data)
+    if path.endswith(".br"):
+        return brotli.decompress(data)
+    return data
+
+
+def _records(raw_tokens: list[dict[str, Any]]) -> list[TokenRecord]:
+    return [TokenRecord(**t) for t in raw_tokens]
+
+
+def load_all(path: str) -> dict[int, list[TokenRecord]]:
+    # all.json, all.json.gz, all.json.br or all.msgpack
+    data = _read(path)
+    if path.endswith(".msgpack"):
+        return unpack_tokens(data)
+    return {int(chain_id): _records(tokens) for chain_id, tokens in json.loads(data).items()}
+
+
+def load_chain(path: str) -> list[TokenRecord]:
+    return _records(json.loads(_read(path)))
@@ -0,0 +1,94 @@
+import hashlib
+import os
+from typing import Literal, Optional
+
+import yaml
+from pydantic import BaseModel, root_validator, validator
+
+from common import TokenRecord
+
+TRUST_POLICY_PATH = os.environ.get("TOKENLISTS_TRUST_POLICY", "trust_policy.yml")
+
+# fields that can come from another provider than the one the rest of the token comes from
+POLICY_FIELDS = ("symbol", "name", "logoURI")
+
+# substring a value must contain (None matches any value) and the priority it gets when it does
+CompiledRules = list[tuple[Optional[str], tuple[int, int]]]
+
+
+class FieldRule(BaseModel):
+    priority: int
+    # every provider when not set
+    providers: Optional[list[str]]
+    # matches only values containing this
+    contains: Optional[str]
+    # which provider wins between values matching the same rule, in tokenlists_providers order
+    prefer: Literal["first", "last"] = "first"
+
+
+class Tier(BaseModel):
+    threshold: float
+    # chain id -> threshold overriding the default one on that chain
+    chains: dict[int, float] = {}
+    # tiers without a folder are only evaluated
+    folder: Optional[str]
+
+    def threshold_for(self, chain_id: int) -> float:
+        return self.chains.get(chain_id, self.threshold)
+
+
+class TrustPolicy(BaseModel):
+    default_weight: float = 1
+    weights: dict[str, float] = {}
+    fields: dict[str, list[FieldRule]] = {}
+    tiers: dict[str, Tier] = {}
+    # the tier collect_trusted_tokens returns
+    default_tier: str
+
+    @validator("fields")
+    def known_fields(cls, v: dict[str, list[FieldRule]]):
+        unknown = v.keys() - set(POLICY_FIELDS)
+        if unknown:
+            raise ValueError(f"only {', '.join(POLICY_FIELDS)} can be configured, got {', '.join(sorted(unknown))}")
+        return v
+
+    @root_validator(skip_on_failure=True)
+    def default_tier_exists(cls, values):
+        if values["default_tier"] not in values["tiers"]:
+            raise ValueError(f"default tier {values['default_tier']} is not one of the tiers")
+        return values
+
+    @classmethod
+    def load(cls, path: str = TRUST_POLICY_PATH) -> "TrustPolicy":
+        with open(path, "r") as stream:
+            return cls.parse_obj(yaml.safe_load(stream))
+
+    def fingerprint(self) -> str:
+        return hashlib.sha256(self.json(sort_keys=True).encode()).hexdigest()
+
+    def score(self, listed_in: list[str]) -> float:
+        weights = self.weights
+        return sum(weights.get(p, self.default_weight) for p in listed_in)
+
+    def tiers_of(self, chain_id: int, tokens: list[TokenRecord]) -> dict[str, list[bool]]:
+        # every token is scored once, whatever the number of tiers
+        scores = [self.score(t.listedIn) for t in tokens]
+        return {
+            name: [score >= tier.threshold_for(chain_id) for score in scores]
+            for name, tier in self.tiers.items()
+        }
+
+    def compile_field_rules(self, field: str, providers: list[str]) -> dict[str, CompiledRules]:
+        # the rules that can apply to each provider, ending with the fallback: the first provider's value
+        res = {}
+        for rank, provider in enumerate(providers):
+            rules: CompiledRules = []
+            for rule in self.fields.get(field, []):
+                if rule.providers is None or provider in rule.providers:
+                    rules.append((rule.contains, (rule.priority, rank if rule.prefer == "last" else -rank)))
+                    if rule.contains is None:
+                        break
+            else:
+                rules.append((None, (0, -rank)))
+            res[provider] = rules
+        return res